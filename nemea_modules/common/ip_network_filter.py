@@ -2,8 +2,9 @@
 Common ADiCT class to unite the filtering of IP prefixes across different modules.
 """
 
+import ipaddress
 import re
-from typing import Iterable
+from typing import Iterable, List, Optional, Tuple
 
 import pytrap
 
@@ -13,6 +14,10 @@ class IPNetworks:
 
     def __init__(self):
         self.networks = set()
+        # The same networks as (first, last) address pairs (as int) for each IP
+        # version, for fast vectorized matching. None if some network can't be
+        # converted (pytrap accepts more formats than the ipaddress module).
+        self._numeric_ranges = {4: [], 6: []}
 
     @staticmethod
     def validate_ipv46_network(
@@ -36,7 +41,7 @@ class IPNetworks:
                 net_str = re.sub(r"(#|//).*", "", line).strip()
                 if net_str == "":
                     continue
-                instance.networks.add(instance.validate_ipv46_network(net_str, line_no))
+                instance.add(net_str, line_no)
         return instance
 
     @classmethod
@@ -46,9 +51,30 @@ class IPNetworks:
 
         for net_str in networks:
             # Validate and add to the set
-            instance.networks.add(instance.validate_ipv46_network(net_str))
+            instance.add(net_str)
         return instance
 
+    def add(self, net_str: str, line_no: int = None):
+        """Validate network string and add it to the set of networks."""
+        self.networks.add(self.validate_ipv46_network(net_str, line_no))
+        if self._numeric_ranges is None:
+            return
+        try:
+            net = ipaddress.ip_network(net_str, strict=False)
+        except ValueError:
+            self._numeric_ranges = None
+            return
+        self._numeric_ranges[net.version].append(
+            (int(net.network_address), int(net.broadcast_address))
+        )
+
+    def numeric_ranges(self, version: int) -> Optional[List[Tuple[int, int]]]:
+        """Return networks of given IP version as list of (first, last) addresses
+        as integers, or None if not available."""
+        if self._numeric_ranges is None:
+            return None
+        return self._numeric_ranges[version]
+
     def __contains__(self, ip: pytrap.UnirecIPAddr) -> bool:
         """Check if IP address belongs to any of the networks."""
         return any(ip in net for net in self.networks)
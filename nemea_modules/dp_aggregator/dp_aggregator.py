@@ -1,16 +1,52 @@
 #!/usr/bin/env python3
 
+import itertools
 import json
+import math
+import multiprocessing
+import os
+import queue
+import random
 import signal
+import sqlite3
 import sys
+import tempfile
 import threading
 import time
 from argparse import ArgumentParser
-from collections import defaultdict
-from datetime import datetime
+from collections import deque
+from datetime import datetime, timezone
+from typing import Optional
 
 import pytrap
 
+# Maximum number of cached parsed/formatted date and time parts (seconds)
+TIME_CACHE_SIZE = 100000
+# When the number of aggregated records in memory exceeds the limit (--max-keys),
+# the least recently updated ones are moved to disk to get to this fraction of the
+# limit
+SPILL_TARGET_FRACTION = 0.75
+# Confidence of data-points without it. Records which got it are recognized by
+# identity (a data-point without confidence overrides even the same value)
+DEFAULT_CONFIDENCE = 1.0
+# Maximum number of closed event-time windows waiting for sending, the receiving
+# thread is blocked when reached (e.g. when historical data are processed)
+CLOSED_WINDOWS_QUEUE_SIZE = 4
+# The watermark follows the median of the newest t2 of this many last messages, so
+# a single message with a wrong time doesn't close the windows too early
+WATERMARK_MESSAGES = 3
+# When no data are received for this long, the watermark is advanced by the clock
+# (if the data received last were current, see advance_watermark)
+IDLE_TIMEOUT = 1  # seconds
+# Number of data-points passed to a worker process at once (see --workers), a
+# smaller batch is passed when the oldest pending data-point waits for this long
+WORKER_BATCH_SIZE = 1000
+WORKER_BATCH_DELAY = 0.5  # seconds
+# How often to check that worker processes are alive while waiting for them
+WORKER_CHECK_INTERVAL = 5  # seconds
+# Number of output messages passed from a worker process to the main one at once
+WORKER_OUTPUT_CHUNK_SIZE = 1000
+
 parser = ArgumentParser(
     description="Receive ADiCT data-points as JSON messages on TRAP interface,"
     " aggregate them and send them via TRAP interface. "
@@ -30,21 +66,243 @@ parser.add_argument(
     default=900,
     help="Set the period of sending data to output (in seconds, default: 900)",
 )
+parser.add_argument(
+    "--inputs",
+    type=int,
+    metavar="N",
+    default=1,
+    help="Number of input interfaces, each is received by its own process "
+    "(more than 1 requires --workers, default: 1)",
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    metavar="N",
+    default=0,
+    help="Aggregate data-points in N worker processes, data-points are "
+    "distributed by a hash of entity type and ID (default: 0, aggregate in the "
+    "main process)",
+)
+parser.add_argument(
+    "--event-time",
+    action="store_true",
+    help="Aggregate data-points into windows of send interval length by their "
+    "time (t2) instead of time of their reception. A window is sent when the "
+    "watermark (newest t2 received minus allowed lateness) passes its end. "
+    "When no data are received, the watermark follows the current time, unless "
+    "the data received last were older than the allowed lateness (a replay).",
+)
+parser.add_argument(
+    "--allowed-lateness",
+    type=float,
+    metavar="seconds",
+    default=60.0,
+    help="How much older data-points than the newest one received are still "
+    "aggregated into their window (with --event-time, in seconds, default: 60)",
+)
+parser.add_argument(
+    "--batch-size",
+    type=int,
+    metavar="N",
+    default=1,
+    help="Number of aggregated data-points sent in one message (default: 1)",
+)
+parser.add_argument(
+    "--pacing",
+    type=float,
+    metavar="FRACTION",
+    default=0.0,
+    help="Spread sending of aggregated data-points evenly over this fraction of "
+    "the send interval instead of sending them all at once (0 to 1, default: 0)",
+)
+parser.add_argument(
+    "--jitter",
+    type=float,
+    metavar="seconds",
+    default=0.0,
+    help="Shift interval boundaries by a random offset up to this number of "
+    "seconds (chosen at start), so multiple instances don't send at the same "
+    "time (default: 0)",
+)
+parser.add_argument(
+    "--max-keys",
+    type=int,
+    metavar="N",
+    default=0,
+    help="Maximum number of aggregated data-points kept in memory, the least recently "
+    "updated ones are moved to a temporary database on disk when exceeded "
+    "(default: 0, no limit)",
+)
+parser.add_argument(
+    "--spill-dir",
+    metavar="DIR",
+    help="Directory for the temporary database (default: system temporary directory)",
+)
 parser.add_argument(
     "-v", "--verbose", action="store_true", help="Set verbose mode - print messages."
 )
 
 args = parser.parse_args()
 
-# Storage for aggregated data-points
-aggregated_data = defaultdict(
-    lambda: {
-        "t1": datetime.max.isoformat(),
-        "t2": datetime.min.isoformat(),
-        "c": 0.0,
-        "src": set(),
-    }
-)
+if args.batch_size < 1:
+    parser.error("--batch-size must be at least 1")
+if not 0 <= args.pacing < 1:
+    parser.error("--pacing must be from interval [0, 1)")
+if args.event_time and (args.max_keys or args.pacing or args.jitter):
+    parser.error("--max-keys, --pacing and --jitter can't be used with --event-time")
+if args.inputs < 1 or args.workers < 0:
+    parser.error("--inputs must be at least 1 and --workers can't be negative")
+if args.inputs > 1 and not args.workers:
+    parser.error("--inputs greater than 1 requires --workers")
+if args.workers and args.event_time:
+    parser.error("--workers can't be used with --event-time")
+
+
+class AggregatedRecord:
+    """Aggregated data-point (value, time interval, confidence and sources)."""
+
+    __slots__ = ("c", "src", "t1", "t2", "v")
+
+    def __init__(self, v, t1: float, t2: float, c: float, src: int):
+        self.v = v  # original value (of the first data-point)
+        self.t1 = t1  # epoch seconds
+        self.t2 = t2
+        self.c = c
+        self.src = src  # bitmask of source tags, see SourceRegistry
+
+
+class SourceRegistry:
+    """Interning of source tags - a set of tags is stored as a bitmask."""
+
+    def __init__(self):
+        self._bits = {}  # tag -> bit
+        self._tags = []  # tags in order of their bits
+
+    def bit(self, tag: str) -> int:
+        bit = self._bits.get(tag)
+        if bit is None:
+            bit = self._bits[tag] = 1 << len(self._tags)
+            self._tags.append(tag)
+        return bit
+
+    def tags(self, mask: int) -> str:
+        """Return comma-separated list of tags in the bitmask."""
+        tags = []
+        i = 0
+        while mask:
+            if mask & 1:
+                tags.append(self._tags[i])
+            mask >>= 1
+            i += 1
+        return ",".join(tags)
+
+
+class SpillStore:
+    """Temporary on-disk (SQLite) store of aggregated records which didn't fit
+    into memory. Records with the same key are merged the same way as in memory.
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        fd, self.path = tempfile.mkstemp(
+            prefix="dp_aggregator_", suffix=".sqlite", dir=directory
+        )
+        os.close(fd)
+        # used by the receiving thread first and then by the sending thread
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode = OFF")
+        self._db.execute("PRAGMA synchronous = OFF")
+        # The bitmask of sources isn't limited to 64 bits, so it's stored as text
+        # (hexadecimal) and merged by a Python function
+        self._db.create_function("src_union", 2, _src_union)
+        self._db.create_function("c_merge", 3, _c_merge)
+        # Type, ID, attribute, value and confidence are stored JSON-encoded, so
+        # they are read back with the same types (e.g. an integer ID or
+        # confidence isn't converted to text or float by column affinity)
+        self._db.execute(
+            "CREATE TABLE records (key TEXT PRIMARY KEY, type TEXT, id TEXT, "
+            "attr TEXT, v TEXT, t1 REAL, t2 REAL, c TEXT, src TEXT)"
+        )
+
+    def add(self, records):
+        """Merge (key, AggregatedRecord) pairs into the store.
+
+        Records already in the store are older, so their value is kept (values
+        with the same key differ in order of dict items at most). Confidence is
+        merged by maximum (the older one is kept when they are equal), unless
+        the newer record got the default confidence from a data-point without
+        it, which is exact for confidences from [0, 1].
+        """
+        self._db.executemany(
+            "INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET t1 = min(t1, excluded.t1), "
+            "t2 = max(t2, excluded.t2), c = c_merge(c, excluded.c, ?), "
+            "src = src_union(src, excluded.src)",
+            (
+                (
+                    json.dumps(key),
+                    json.dumps(key[0]),
+                    json.dumps(key[1]),
+                    json.dumps(key[2]),
+                    json.dumps(rec.v),
+                    rec.t1,
+                    rec.t2,
+                    json.dumps(rec.c),
+                    format(rec.src, "x"),
+                    rec.c is DEFAULT_CONFIDENCE,
+                )
+                for key, rec in records
+            ),
+        )
+        self._db.commit()
+
+    def __len__(self) -> int:
+        return self._db.execute("SELECT count(*) FROM records").fetchone()[0]
+
+    def records(self):
+        """Iterate over stored records as (type, id, attr, v, t1, t2, c, src)."""
+        for row in self._db.execute(
+            "SELECT type, id, attr, v, t1, t2, c, src FROM records"
+        ):
+            yield (
+                *map(json.loads, row[:4]),
+                row[4],
+                row[5],
+                json.loads(row[6]),
+                int(row[7], 16),
+            )
+
+    def close(self):
+        """Close and remove the store."""
+        self._db.close()
+        os.remove(self.path)
+
+
+def _src_union(a: str, b: str) -> str:
+    return format(int(a, 16) | int(b, 16), "x")
+
+
+def _c_merge(old: str, new: str, default: int) -> str:
+    if default or json.loads(new) > json.loads(old):
+        return new
+    return old
+
+
+# Storage for aggregated data-points (key -> AggregatedRecord), the sending thread
+# replaces it by an empty one at the end of each interval
+aggregated_data = {}
+# Records which didn't fit into memory (in the current interval)
+spill_store = None
+sources = SourceRegistry()
+# Event-time mode: open windows (window start -> storage like aggregated_data),
+# the watermark (and the newest t2 of last messages and when the last one was
+# received) and the number of dropped late data-points
+windows = {}
+watermark = -math.inf
+recent_t2 = deque(maxlen=WATERMARK_MESSAGES)
+last_received = 0.0
+late_count = 0
+# Closed windows (window start, storage) waiting for sending, None ends sending
+closed_windows = queue.Queue(CLOSED_WINDOWS_QUEUE_SIZE)
 # Lock to prevent concurrent access to aggregated_data
 lock = threading.Lock()
 # Stop flags
@@ -56,33 +314,225 @@ stop_flag_send = (
 )  # used to stop the sending thread after the receiving loop stops
 
 
-def process_data_points(dp):
+def freeze(value):
+    """Return canonical hashable representation of a value decoded from JSON.
+
+    Two values have the same representation if and only if their JSON
+    serializations (with sorted keys) are the same, so it can be used as a part
+    of the aggregation key instead of the serialized value.
+    """
+    if isinstance(value, dict):
+        return ("d", tuple(sorted((k, freeze(v)) for k, v in value.items())))
+    if isinstance(value, list):
+        return ("l", tuple(freeze(v) for v in value))
+    # bool is a subclass of int and True == 1 == 1.0, but their JSON differs
+    if isinstance(value, bool):
+        return ("b", value)
+    if isinstance(value, float):
+        return ("f", repr(value))
+    return value  # str, int or None
+
+
+def parse_time(t: str) -> float:
+    """Parse ISO timestamp (YYYY-MM-DDThh:mm:ss[.f...][Z|+hh:mm|-hh:mm]) to epoch.
+
+    Timestamps without timezone are considered to be in UTC. The date and time
+    part (up to seconds) is cached, most timestamps share it with many others.
+    """
+    base = _parsed_time_cache.get(t[:19])
+    if base is None:
+        # fromisoformat accepts also shorter forms (and a timezone within them)
+        if len(t) < 19 or t[10] not in "T " or t[13] != ":" or t[16] != ":":
+            raise ValueError(f"Invalid timestamp '{t}'")
+        dt = datetime.fromisoformat(t[:19])
+        base = dt.replace(tzinfo=timezone.utc).timestamp()
+        if len(_parsed_time_cache) >= TIME_CACHE_SIZE:
+            _parsed_time_cache.clear()
+        _parsed_time_cache[t[:19]] = base
+    if len(t) == 19:
+        return base
+    rest = t[19:]
+    if rest[0] == ".":
+        end = 1
+        while end < len(rest) and rest[end].isdigit():
+            end += 1
+        base += float(rest[:end])
+        rest = rest[end:]
+    if not rest or rest in ("Z", "z"):
+        return base
+    # timezone offset (+hh:mm, +hhmm or +hh)
+    sign = rest[0]
+    if sign not in "+-" or len(rest.replace(":", "")) not in (3, 5):
+        raise ValueError(f"Invalid timezone in timestamp '{t}'")
+    offset = rest[1:].replace(":", "")
+    offset_seconds = int(offset[:2]) * 3600 + int(offset[2:] or 0) * 60
+    return base - offset_seconds if sign == "+" else base + offset_seconds
+
+
+_parsed_time_cache = {}  # date and time part -> epoch
+
+
+def format_time(epoch: float) -> str:
+    """Format epoch as ISO timestamp in UTC (YYYY-MM-DDThh:mm:ss[.fff[fff]])."""
+    seconds, micros = divmod(round(epoch * 1000000), 1000000)
+    prefix = _formatted_time_cache.get(seconds)
+    if prefix is None:
+        prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds))
+        if len(_formatted_time_cache) >= TIME_CACHE_SIZE:
+            _formatted_time_cache.clear()
+        _formatted_time_cache[seconds] = prefix
+    if not micros:
+        return prefix
+    if micros % 1000 == 0:
+        return f"{prefix}.{micros // 1000:03d}"
+    return f"{prefix}.{micros:06d}"
+
+
+_formatted_time_cache = {}  # epoch seconds -> formatted date and time
+
+
+def parse_data_points(dp) -> list:
+    """Parse timestamps and make aggregation keys of data-points from a message.
+
+    Returns list of (key, t1, t2, data-point), invalid data-points are skipped.
+    """
+    parsed = []
     for data in dp:
-        key = (
-            data["type"],
-            data["id"],
-            data["attr"],
-            json.dumps(data["v"], sort_keys=True),
-        )
-        with lock:
-            rec = aggregated_data[key]
-            rec["t1"] = min(rec["t1"], data["t1"])
-            rec["t2"] = max(rec["t2"], data["t2"])
+        try:
+            t1 = parse_time(data["t1"])
+            t2 = parse_time(data["t2"])
+        except (ValueError, TypeError, IndexError) as e:
+            print(
+                f"ERROR: Invalid timestamp in data-point {data}: {e}", file=sys.stderr
+            )
+            continue
+        key = (data["type"], data["id"], data["attr"], freeze(data["v"]))
+        parsed.append((key, t1, t2, data))
+    return parsed
+
+
+def aggregate_data_points(parsed: list):
+    """Merge parsed data-points (see parse_data_points) into aggregated data."""
+    global late_count, watermark, last_received  # noqa PLW0603
+    # The lock is taken once for the whole message
+    closed = []
+    with lock:
+        for key, t1, t2, data in parsed:
+            if args.event_time:
+                window_start = t2 - t2 % args.send_interval
+                if window_start + args.send_interval <= watermark:
+                    late_count += 1  # the window was already closed
+                    continue
+                storage = windows.get(window_start)
+                if storage is None:
+                    storage = windows[window_start] = {}
+            else:
+                storage = aggregated_data
+            src = sources.bit(data["src"]) if data["src"] else 0
+            rec = storage.get(key)
+            if rec is None:
+                c = max(0.0, data["c"]) if "c" in data else DEFAULT_CONFIDENCE
+                storage[key] = AggregatedRecord(data["v"], t1, t2, c, src)
+                continue
+            rec.t1 = min(rec.t1, t1)
+            rec.t2 = max(rec.t2, t2)
 
             if "c" in data:
-                rec["c"] = max(rec["c"], data["c"])
+                rec.c = max(rec.c, data["c"])
             else:
-                rec["c"] = 1.0
+                rec.c = DEFAULT_CONFIDENCE
+
+            rec.src |= src
+            if args.max_keys:
+                # Keep the records ordered by the last update, so the ones not
+                # updated for the longest time are moved to disk first
+                storage[key] = storage.pop(key)
+
+        if args.event_time and parsed:
+            # A data-point with a wrong time (e.g. from a source with wrong clock)
+            # must not make all the following ones late, so times in future are
+            # taken as the current time and outliers are ignored (by the median)
+            last_received = time.time()
+            recent_t2.append(min(max(t2 for _, _, t2, _ in parsed), last_received))
+            if len(recent_t2) == WATERMARK_MESSAGES:
+                newest = sorted(recent_t2)[WATERMARK_MESSAGES // 2]
+                watermark = max(watermark, newest - args.allowed_lateness)
+            closed = close_windows(watermark)
+        elif 0 < args.max_keys < len(aggregated_data):
+            spill_records()
+    # Queue closed windows without the lock, it may block
+    for window in closed:
+        closed_windows.put(window)
+
 
-            if data["src"]:
-                rec["src"].add(data["src"])
+def advance_watermark():
+    """Advance the watermark by the clock when no data are received.
+
+    Otherwise a window would stay open until next data arrive. It's done only
+    when the newest t2 of the last messages was within the allowed lateness from
+    the time of their reception, so replays of historical data aren't affected.
+    """
+    global watermark  # noqa PLW0603
+    with lock:
+        if not recent_t2:
+            return
+        newest = sorted(recent_t2)[len(recent_t2) // 2]
+        if newest < last_received - args.allowed_lateness:
+            return
+        watermark = max(watermark, time.time() - args.allowed_lateness)
+        closed = close_windows(watermark)
+    for window in closed:
+        closed_windows.put(window)
+
+
+def close_windows(until: float) -> list:
+    """Remove windows ending before given time from open windows and return them
+    as (window start, storage) sorted by time (must be called with lock).
+    """
+    closed = []
+    for window_start in sorted(windows):
+        if window_start + args.send_interval > until:
+            break
+        closed.append((window_start, windows.pop(window_start)))
+    return closed
+
+
+def spill_records():
+    """Move the least recently updated records from memory to disk (must be called
+    with lock)."""
+    global spill_store  # noqa PLW0603
+    if spill_store is None:
+        spill_store = SpillStore(args.spill_dir)
+    count = len(aggregated_data) - int(args.max_keys * SPILL_TARGET_FRACTION)
+    keys = list(itertools.islice(aggregated_data, count))
+    spill_store.add((key, aggregated_data[key]) for key in keys)
+    for key in keys:
+        del aggregated_data[key]
+    if args.verbose:
+        print(
+            f"{datetime.now().isoformat()}: {count} records moved to disk", flush=True
+        )
+
+
+def take_aggregated_data() -> tuple:
+    """Replace aggregated data by empty ones, return the original ones (records in
+    memory and the spill store or None).
+    """
+    global aggregated_data, spill_store  # noqa PLW0603
+    with lock:
+        aggregated_data_copy = aggregated_data
+        aggregated_data = {}
+        spilled = spill_store
+        spill_store = None
+    return aggregated_data_copy, spilled
 
 
 def sending_thread_func(trap, send_interval):
+    offset = random.uniform(0, min(args.jitter, send_interval))
     while True:
-        # Compute the next boundary of a time interval
+        # Compute the next boundary of a time interval (shifted by the offset)
         now = time.time()
-        interval_end = now - (now % send_interval) + send_interval
+        interval_end = now - ((now - offset) % send_interval) + send_interval
         # Wait until the end of the time interval or the stop flag is set
         if args.verbose:
             print(
@@ -91,40 +541,289 @@ def sending_thread_func(trap, send_interval):
                 flush=True,
             )
         do_stop = stop_flag_send.wait(max(0, interval_end - time.time()))
-        # Send content aggregated_data to output interface
-        with lock:
-            aggregated_data_copy = aggregated_data.copy()
-            aggregated_data.clear()
-        send_aggregated_data(trap, aggregated_data_copy)
+        # Don't pace the last sending when stopping
+        duration = 0 if do_stop else args.pacing * send_interval
+        # Send content aggregated_data (of this or worker processes) to output
+        if pool is not None:
+            pool.send(trap, duration)
+        else:
+            aggregated_data_copy, spilled = take_aggregated_data()
+            send_aggregated_data(trap, aggregated_data_copy, spilled, duration)
         if do_stop:
             break  # stop_flag was set -> stop thread
 
 
-def send_aggregated_data(trap, aggregated_data_copy):
+def event_time_sending_thread_func(trap):
+    global late_count  # noqa PLW0603
+    while True:
+        window = closed_windows.get()
+        if window is None:
+            break  # input processing finished and all windows were sent
+        window_start, storage = window
+        with lock:
+            late, late_count = late_count, 0
+        if late:
+            print(
+                f"WARNING: {late} late data-points (of already sent windows) "
+                f"dropped before window {format_time(window_start)} was closed",
+                file=sys.stderr,
+                flush=True,
+            )
+        if args.verbose:
+            print(
+                f"{datetime.now().isoformat()}: Window "
+                f"{format_time(window_start)} closed",
+                flush=True,
+            )
+        send_aggregated_data(trap, storage)
+
+
+def send_aggregated_data(trap, aggregated_data_copy, spilled=None, duration=0):
+    """Send aggregated data-points in messages of args.batch_size data-points.
+
+    If duration is given, the messages are sent evenly during that time (in
+    seconds). Setting of the stop flag ends the pacing, the rest is sent at once.
+    """
+    send_messages(trap, *build_messages(aggregated_data_copy, spilled), duration)
+
+
+def build_messages(aggregated_data_copy, spilled=None) -> tuple:
+    """Return the number of aggregated data-points, the number of messages and
+    an iterator of the messages (JSON strings) to send.
+    """
+    if spilled is not None:
+        # Merge records in memory with those on disk and send all from there
+        spilled.add(aggregated_data_copy.items())
+        count = len(spilled)
+        records = spilled.records()
+    else:
+        count = len(aggregated_data_copy)
+        records = (
+            (*key[:3], rec.v, rec.t1, rec.t2, rec.c, rec.src)
+            for key, rec in aggregated_data_copy.items()
+        )
+    n_messages = -(-count // args.batch_size)
+    return count, n_messages, _iter_messages(records, count, spilled)
+
+
+def _iter_messages(records, count: int, spilled):
+    batch = []
+    for i, (type_, id_, attr, v, t1, t2, c, src) in enumerate(records, 1):
+        batch.append(
+            {
+                "type": type_,
+                "id": id_,
+                "attr": attr,
+                "v": v,
+                "t1": format_time(t1),
+                "t2": format_time(t2),
+                "c": c,
+                "src": sources.tags(src),
+            }
+        )
+        if len(batch) < args.batch_size and i < count:
+            continue
+        yield json.dumps(batch)
+        batch = []
+    if spilled is not None:
+        spilled.close()
+
+
+def send_messages(trap, count: int, n_messages: int, messages, duration=0):
+    """Send messages with aggregated data-points, evenly during given duration."""
     if args.verbose:
         print(
             f"{datetime.now().isoformat()}: "
-            f"Sending {len(aggregated_data_copy)} aggregated datapoints ...",
+            f"Sending {count} aggregated datapoints ...",
             flush=True,
         )
-
-    for key, data in aggregated_data_copy.items():
-        aggregated_dp = {
-            "type": key[0],
-            "id": key[1],
-            "attr": key[2],
-            "v": json.loads(key[3]),
-            "t1": data["t1"],
-            "t2": data["t2"],
-            "c": data["c"],
-            "src": ",".join(data["src"]),
-        }
-        datapoint = json.dumps([aggregated_dp])
-        trap.send(bytearray(datapoint, "utf-8"))
+    message_interval = duration / n_messages if n_messages else 0
+    start = time.time()
+    for sent, message in enumerate(messages):
+        if message_interval and not stop_flag_send.is_set():
+            stop_flag_send.wait(start + sent * message_interval - time.time())
+        trap.send(bytearray(message, "utf-8"))
     if args.verbose:
         print(f"{datetime.now().isoformat()}: Done", flush=True)
 
 
+# Worker processes (--workers)
+#
+# Input interfaces are received by receiver processes (one per interface), which
+# decode the messages and parse the data-points. The data-points are passed to
+# worker processes by a hash of (type, id), so all data-points with the same key
+# are aggregated by the same worker. The main process only sends the output:
+# at the end of each interval, it collects messages to send from all workers.
+#
+# Messages sent to a worker (via its own queue) are tuples (command, argument):
+#   ("data", list of parsed data-points), ("collect", None) - worker replies
+#   (via its own output queue) with (number of data-points, number of messages),
+#   then with lists of messages and None at the end, ("stop", None)
+
+
+def worker_process_func(
+    in_queue: multiprocessing.Queue, out_queue: multiprocessing.Queue
+):
+    """Main function of a worker process (see above)."""
+    # Signals are handled by the main process, which stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    while True:
+        command, arg = in_queue.get()
+        if command == "data":
+            aggregate_data_points(arg)
+        elif command == "collect":
+            count, n_messages, messages = build_messages(*take_aggregated_data())
+            out_queue.put((count, n_messages))
+            while True:
+                chunk = list(itertools.islice(messages, WORKER_OUTPUT_CHUNK_SIZE))
+                if not chunk:
+                    break
+                out_queue.put(chunk)
+            out_queue.put(None)
+        elif command == "stop":
+            return
+
+
+class WorkerPool:
+    """Pool of worker processes aggregating data-points (see above)."""
+
+    def __init__(self, workers: int):
+        ctx = multiprocessing.get_context("fork")
+        self._in_queues = [ctx.Queue() for _ in range(workers)]
+        self._out_queues = [ctx.Queue() for _ in range(workers)]
+        self._pending = [[] for _ in range(workers)]
+        # time when the oldest of the pending data-points was received
+        self._pending_since = None
+        self._failed = False
+        self._workers = [
+            ctx.Process(
+                target=worker_process_func, args=(in_queue, out_queue), daemon=True
+            )
+            for in_queue, out_queue in zip(self._in_queues, self._out_queues)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def dispatch(self, parsed: list):
+        """Pass parsed data-points to the workers given by a hash of (type, id).
+
+        Called by receiver processes. All processes are forked from the main one,
+        so they use the same seed of string hashes.
+        """
+        if self._pending_since is None:
+            self._pending_since = time.time()
+        for item in parsed:
+            i = hash(item[0][:2]) % len(self._pending)
+            pending = self._pending[i]
+            pending.append(item)
+            if len(pending) >= WORKER_BATCH_SIZE:
+                self._in_queues[i].put(("data", pending))
+                self._pending[i] = []
+        # Don't keep data-points waiting for long (they would be sent in a later
+        # interval), even if messages come too often to reach the receive timeout
+        if time.time() - self._pending_since >= WORKER_BATCH_DELAY:
+            self.flush()
+
+    def flush(self):
+        """Pass all pending data-points to workers."""
+        for i, pending in enumerate(self._pending):
+            if pending:
+                self._in_queues[i].put(("data", pending))
+                self._pending[i] = []
+        self._pending_since = None
+
+    def check_workers(self) -> bool:
+        """Return False if any worker process died (an error is printed once).
+
+        Aggregated data-points of the dead worker are lost, so the input is stopped.
+        """
+        if not self._failed:
+            for worker in self._workers:
+                if not worker.is_alive():
+                    print(
+                        f"ERROR: Worker process {worker.pid} died "
+                        f"(exit code {worker.exitcode}), stopping.",
+                        file=sys.stderr,
+                    )
+                    self._failed = True
+            if self._failed:
+                stop_flag_recv.set()
+        return not self._failed
+
+    def _get(self, i: int):
+        """Get a reply of the i-th worker, return None if the worker is dead."""
+        while True:
+            try:
+                return self._out_queues[i].get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                if not self._workers[i].is_alive():
+                    self.check_workers()
+                    return None
+
+    def send(self, trap, duration=0):
+        """Collect aggregated data-points from all workers and send them."""
+        for in_queue in self._in_queues:
+            in_queue.put(("collect", None))
+        counts = [self._get(i) or (0, 0) for i in range(len(self._workers))]
+        send_messages(
+            trap,
+            sum(count for count, _ in counts),
+            sum(n_messages for _, n_messages in counts),
+            self._iter_messages(),
+            duration,
+        )
+
+    def _iter_messages(self):
+        for i in range(len(self._workers)):
+            for chunk in iter(lambda i=i: self._get(i), None):
+                yield from chunk
+
+    def stop(self):
+        """Stop all workers."""
+        for in_queue, worker in zip(self._in_queues, self._workers):
+            in_queue.put(("stop", None))
+            if not worker.is_alive():
+                # Nobody reads the queue, don't wait for it to be written at exit
+                in_queue.cancel_join_thread()
+        for worker in self._workers:
+            worker.join()
+
+    def wait_for_receivers(self, receivers: list):
+        """Wait for the receiver processes to finish, checking the workers.
+
+        If a worker dies, the receivers are stopped. Those not finished within
+        WORKER_CHECK_INTERVAL are killed then (they ignore SIGTERM), as they may
+        be blocked by data-points which can't be passed to the dead worker.
+        """
+        for receiver in receivers:
+            while receiver.is_alive():
+                receiver.join(WORKER_CHECK_INTERVAL)
+                if not self.check_workers():
+                    receiver.join(WORKER_CHECK_INTERVAL)
+                    if receiver.is_alive():
+                        receiver.kill()
+                        receiver.join()
+
+
+def receiver_process_func(ifcspec: str):
+    """Main function of a receiver process, receives one input interface and
+    passes the data-points to the worker processes."""
+    # Signals are handled by the main process, which sets stop_flag_recv
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGABRT, signal.SIG_IGN)
+    trap = pytrap.TrapCtx()
+    trap.init(["-i", ifcspec], 1, 0)
+    trap.setRequiredFmt(0, pytrap.FMT_JSON, "")
+    # Pass pending data-points to workers (and check the stop flag) at least
+    # every 0.5 s also when no data are received
+    trap.ifcctl(ifcidx=0, dir_in=True, request=pytrap.CTL_TIMEOUT, value=500000)
+    process_input_data(trap)
+    pool.flush()
+    trap.finalize()
+
+
 def process_input_data(trap):
     # Main loop (trap.stop is set to True when SIGINT or SIGTERM is received)
     while not stop_flag_recv.is_set():
@@ -145,6 +844,12 @@ def process_input_data(trap):
             pass
         except pytrap.Terminated:
             break
+        except pytrap.TimeoutError:
+            if pool is not None:
+                pool.flush()
+            elif args.event_time:
+                advance_watermark()
+            continue
 
         # Check for "end-of-stream" record
         if len(data) <= 1:
@@ -159,10 +864,21 @@ def process_input_data(trap):
             print(f"ERROR: Can't decode received data: {e}", file=sys.stderr)
             continue
 
-        process_data_points(rec_list)
+        parsed = parse_data_points(rec_list)
+        if pool is not None:
+            pool.dispatch(parsed)
+        else:
+            aggregate_data_points(parsed)
 
     # Input processing finished, stop the sending thread
     stop_flag_send.set()
+    if args.event_time:
+        # Send all the remaining windows
+        with lock:
+            closed = close_windows(math.inf)
+        for window in closed:
+            closed_windows.put(window)
+        closed_windows.put(None)
 
 
 def stop_program(signum, frame):
@@ -180,24 +896,63 @@ def stop_program(signum, frame):
         )
 
 
-trap = pytrap.TrapCtx()
-trap.init(["-i", args.ifcspec], 1, 1)
-trap.setRequiredFmt(0, pytrap.FMT_JSON, "")
-trap.setDataFmt(0, pytrap.FMT_JSON, "adict_datapoint")
-
 # Register signal handler on common stopping signals - sets the "stop_flag_recv" event
 signal.signal(signal.SIGINT, stop_program)
 signal.signal(signal.SIGTERM, stop_program)
 signal.signal(signal.SIGABRT, stop_program)
 
+pool = None
+receivers = []
+if args.workers:
+    # Inputs are received by receiver processes, the main process has the output
+    # interface only. Processes must be forked before any TRAP context is created.
+    ifcspecs = args.ifcspec.split(",") if args.ifcspec else []
+    if len(ifcspecs) != args.inputs + 1:
+        parser.error(f"{args.inputs} input and 1 output interfaces expected in -i")
+    ctx = multiprocessing.get_context("fork")
+    stop_flag_recv = ctx.Event()  # set by the main process, checked by receivers
+    pool = WorkerPool(args.workers)
+    receivers = [
+        ctx.Process(target=receiver_process_func, args=(ifcspec,))
+        for ifcspec in ifcspecs[:-1]
+    ]
+    for receiver in receivers:
+        receiver.start()
+    trap = pytrap.TrapCtx()
+    trap.init(["-i", ifcspecs[-1]], 0, 1)
+else:
+    trap = pytrap.TrapCtx()
+    trap.init(["-i", args.ifcspec], 1, 1)
+    trap.setRequiredFmt(0, pytrap.FMT_JSON, "")
+    if args.event_time:
+        # Advance the watermark also when no data are received
+        trap.ifcctl(
+            ifcidx=0,
+            dir_in=True,
+            request=pytrap.CTL_TIMEOUT,
+            value=IDLE_TIMEOUT * 1000000,
+        )
+trap.setDataFmt(0, pytrap.FMT_JSON, "adict_datapoint")
+
 # Create and start the sending thread
-sending_thread = threading.Thread(
-    target=sending_thread_func, args=(trap, args.send_interval)
-)
+if args.event_time:
+    sending_thread = threading.Thread(
+        target=event_time_sending_thread_func, args=(trap,)
+    )
+else:
+    sending_thread = threading.Thread(
+        target=sending_thread_func, args=(trap, args.send_interval)
+    )
 sending_thread.start()
 
-# Start processing input data (in the main thread)
-process_input_data(trap)
-
-sending_thread.join()
+if pool is not None:
+    # Wait for the receivers, then send the rest of data and stop the workers
+    pool.wait_for_receivers(receivers)
+    stop_flag_send.set()
+    sending_thread.join()
+    pool.stop()
+else:
+    # Start processing input data (in the main thread)
+    process_input_data(trap)
+    sending_thread.join()
 trap.finalize()
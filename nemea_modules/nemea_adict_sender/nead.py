@@ -1,12 +1,31 @@
 #!/usr/bin/env python3
 
 import json
+import re
 import sys
+import threading
+import time
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 
 import pytrap
 import requests
 
+# Delay before the first retry of a failed request, doubled after each retry
+RETRY_BACKOFF_INITIAL = 0.5  # seconds
+RETRY_BACKOFF_MAX = 30  # seconds
+# Timeout of receiving from the input interface, to send old batches in time
+RECV_TIMEOUT = 100000  # microseconds
+# Weight of the last response time in the average latency of an endpoint
+LATENCY_EWMA_WEIGHT = 0.2
+# A response slower than this multiple of the average latency of the endpoint
+# decreases its concurrency limit (as well as a failed request)
+LATENCY_LIMIT_FACTOR = 2.0
+# Number of consecutive failed requests after which an endpoint is taken out
+# of rotation for ENDPOINT_COOLDOWN seconds (then it's tried by one request)
+ENDPOINT_FAILURES_LIMIT = 3
+ENDPOINT_COOLDOWN = 10  # seconds
+
 parser = ArgumentParser(
     description="Receive ADiCT data-points as JSON messages on TRAP interface "
     "and send them via HTTP API to ADiCT server "
@@ -23,8 +42,10 @@ parser.add_argument(
     "-u",
     "--url",
     metavar="url",
+    nargs="+",
     help="Base URL of ADiCT server, e.g. http://example.com/adict/ "
-    "(print data-points to stdout if not specified)",
+    "(print data-points to stdout if not specified). More URLs (of API workers "
+    "of the same server) can be given, requests are balanced among them.",
 )
 parser.add_argument(
     "-s",
@@ -41,23 +62,400 @@ parser.add_argument(
     type=int,
     help="When writing to stdout, pretty-print JSON with indentation set to N spaces.",
 )
+parser.add_argument(
+    "--check",
+    choices=("full", "structure", "none"),
+    default="full",
+    help="Checking of received messages when sending to ADiCT server: 'full' - "
+    "decode and re-encode them (default), 'structure' - pass them through after "
+    "a cheap check that they are lists of objects, 'none' - pass them through "
+    "without any check (can't be used with --src)",
+)
+parser.add_argument(
+    "-b",
+    "--batch-size",
+    metavar="N",
+    type=int,
+    default=1000,
+    help="Send data-points from multiple messages in one request, up to N "
+    "data-points (a larger message is sent alone, default: 1000)",
+)
+parser.add_argument(
+    "--batch-delay",
+    metavar="SECONDS",
+    type=float,
+    default=1.0,
+    help="Maximum time a data-point waits for more data-points to fill the batch "
+    "(default: 1.0)",
+)
+parser.add_argument(
+    "-c",
+    "--concurrency",
+    metavar="N",
+    type=int,
+    default=4,
+    help="Maximum number of requests in flight to each URL (each has its own "
+    "keep-alive connection), adapted to the latency and errors (default: 4)",
+)
+parser.add_argument(
+    "--timeout",
+    metavar="SECONDS",
+    type=float,
+    default=10.0,
+    help="Timeout of HTTP requests (default: 10)",
+)
+parser.add_argument(
+    "--retries",
+    metavar="N",
+    type=int,
+    default=3,
+    help="Number of retries of a failed request, with exponential backoff "
+    "(default: 3)",
+)
 parser.add_argument(
     "-v", "--verbose", action="store_true", help="Set verbose mode - print messages."
 )
 
 args = parser.parse_args()
+if args.batch_size < 1 or args.concurrency < 1 or args.retries < 0:
+    parser.error("--batch-size and --concurrency must be positive, --retries >= 0")
+if args.check == "none" and args.src:
+    parser.error("--check none can't be used with --src")
 
-# Append "/datapoints" to the end of given URL, if it is not already there
-url = args.url
-if url and not url.endswith("/datapoints"):
+
+def datapoints_url(url: str) -> str:
+    """Append "/datapoints" to the end of given URL, if it is not already there."""
+    if url.endswith("/datapoints"):
+        return url
     if url[-1] == "/":
-        url += "datapoints"
-    else:
-        url += "/datapoints"
+        return url + "datapoints"
+    return url + "/datapoints"
+
+
+urls = [datapoints_url(url) for url in args.url or []]
+
+
+def get_http_session() -> requests.Session:
+    """Return HTTP session (with keep-alive connections) of the current thread."""
+    session = getattr(_thread_local, "http_session", None)
+    if session is None:
+        session = _thread_local.http_session = requests.Session()
+    return session
+
+
+_thread_local = threading.local()
+
+
+# Regular expression for the quick check of messages passed through without
+# decoding (see pass_message) - a list of non-empty objects without nested
+# objects/lists and without braces in strings. Values must be valid JSON strings
+# (of valid UTF-8), numbers, true, false or null. Each repetition starts with
+# a different character than the preceding one, so a failed match doesn't
+# backtrack much.
+_WS = rb"[ \t\n\r]*"
+_UTF8_MULTIBYTE = (
+    rb"[\xc2-\xdf][\x80-\xbf]|\xe0[\xa0-\xbf][\x80-\xbf]"
+    rb"|[\xe1-\xec\xee\xef][\x80-\xbf]{2}|\xed[\x80-\x9f][\x80-\xbf]"
+    rb"|\xf0[\x90-\xbf][\x80-\xbf]{2}|[\xf1-\xf3][\x80-\xbf]{3}"
+    rb"|\xf4[\x80-\x8f][\x80-\xbf]{2}"
+)
+_STRING_CHARS = rb"[\x20\x21\x23-\x5b\x5d-\x7a\x7c\x7e\x7f]*"
+_STRING = (
+    rb'"'
+    + _STRING_CHARS
+    + rb'(?:(?:\\(?:["\\/bfnrt]|u[0-9a-fA-F]{4})|'
+    + _UTF8_MULTIBYTE
+    + rb")"
+    + _STRING_CHARS
+    + rb')*"'
+)
+_SCALAR = (
+    _STRING + rb"|-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?|true|false|null"
+)
+_MEMBER = _STRING + _WS + rb":" + _WS + rb"(?:" + _SCALAR + rb")" + _WS
+_FLAT_OBJECT = rb"\{" + _WS + _MEMBER + rb"(?:," + _WS + _MEMBER + rb")*\}"
+_ITEMS = _FLAT_OBJECT + _WS + rb"(?:," + _WS + _FLAT_OBJECT + _WS + rb")*"
+_FLAT_OBJECT_LIST_RE = re.compile(
+    _WS + rb"\[" + _WS + rb"(?:" + _ITEMS + rb")?\]" + _WS
+)
+
+
+def decode_message(data: bytes):
+    """Decode a message, return list of data-points (dicts) or None if invalid."""
+    try:
+        # Decode data (and check it's a valid JSON)
+        rec_list = json.loads(data.decode("utf-8"))
+    except ValueError as e:
+        print(f"ERROR: Can't decode received data: {e}", file=sys.stderr)
+        return None
+
+    # Check format - must be a list of objects
+    if not isinstance(rec_list, list) or any(
+        not isinstance(rec, dict) for rec in rec_list
+    ):
+        print(
+            "ERROR: Invalid format of incoming data, must be a list of objects.",
+            file=sys.stderr,
+        )
+        return None
+
+    # Add "src" tag
+    if args.src:
+        for rec in rec_list:
+            rec["src"] = args.src
+    return rec_list
+
+
+def pass_message(data: bytes):
+    """Return content of the list of data-points in a message (without the
+    brackets) and the number of data-points, or None if the message is invalid.
+
+    Messages with flat data-points (the usual case) are passed through as they
+    are, only their structure is checked. Then each brace is a start or end of
+    a data-point, so the "src" tag can be added before each closing one (if a
+    data-point has it already, the last one is used when it's decoded).
+    Other messages are decoded and encoded again. With --check none, messages
+    aren't checked at all and the number of messages is counted instead of
+    data-points.
+    """
+    if args.check == "none":
+        return data.strip()[1:-1].strip(), 1
+    if _FLAT_OBJECT_LIST_RE.fullmatch(data) is None:
+        rec_list = decode_message(data)
+        if rec_list is None:
+            return None
+        return json.dumps(rec_list)[1:-1].encode(), len(rec_list)
+    part = data.strip()[1:-1].strip()
+    if args.src:
+        part = part.replace(b"}", src_item)
+    return part, part.count(b"{")
+
+
+src_item = b',"src":' + json.dumps(args.src).encode() + b"}"
+
+
+class BatchBuilder:
+    """Coalesces data-points from multiple messages into one request body,
+    up to max_size data-points or max_delay seconds since the first one."""
+
+    def __init__(self, max_size: int, max_delay: float):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._parts = []  # JSON-encoded data-points (without the list brackets)
+        self._count = 0
+        self._first_time = 0.0
+
+    def add(self, part: bytes, count: int):
+        """Add JSON-encoded content of a list of 'count' data-points."""
+        if not self._parts:
+            self._first_time = time.monotonic()
+        self._parts.append(part)
+        self._count += count
+
+    def would_overflow(self, count: int) -> bool:
+        """Return True if adding 'count' data-points would exceed the size."""
+        return bool(self._parts) and self._count + count > self.max_size
+
+    def is_ready(self) -> bool:
+        """Return True if the batch is full or old enough to be sent."""
+        return self._count >= self.max_size or (
+            bool(self._parts) and time.monotonic() - self._first_time >= self.max_delay
+        )
+
+    def take(self):
+        """Return (body, number of data-points) and start a new batch, or None if
+        the batch is empty."""
+        if not self._parts:
+            return None
+        body = b"[" + b",".join(self._parts) + b"]"
+        count = self._count
+        self._parts = []
+        self._count = 0
+        return body, count
+
+
+class Endpoint:
+    """URL of ADiCT API with statistics for load balancing and an adaptive limit
+    of requests in flight (additive increase, multiplicative decrease).
+
+    Must be used with the lock of the Forwarder.
+    """
+
+    def __init__(self, url: str, max_concurrency: int):
+        self.url = url
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)  # current limit of requests in flight
+        self.in_flight = 0
+        self.latency = 0.0  # average response time (EWMA), 0 if not known yet
+        self.failures = 0  # number of consecutive failed requests
+        self.down_until = 0.0  # out of rotation until this time (monotonic)
+        self.sent = 0  # number of data-points sent
+
+    def is_available(self, now: float) -> bool:
+        return self.down_until <= now and self.in_flight < int(self.limit)
+
+    def expected_wait(self) -> float:
+        """Expected time to process a new request (used to select an endpoint)."""
+        return (self.in_flight + 1) * self.latency
+
+    def record_success(self, latency: float, count: int):
+        if self.latency and latency > LATENCY_LIMIT_FACTOR * self.latency:
+            self.limit = max(1.0, self.limit / 2)
+        else:
+            self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+        if self.latency:
+            self.latency += LATENCY_EWMA_WEIGHT * (latency - self.latency)
+        else:
+            self.latency = latency
+        self.failures = 0
+        self.sent += count
+
+    def record_failure(self, now: float):
+        self.limit = max(1.0, self.limit / 2)
+        self.failures += 1
+        if self.failures >= ENDPOINT_FAILURES_LIMIT:
+            self.down_until = now + ENDPOINT_COOLDOWN
+            self.limit = 1.0
+            print(
+                f"WARNING: {self.url} failed {self.failures} times in a row, "
+                f"not used for {ENDPOINT_COOLDOWN} s",
+                file=sys.stderr,
+            )
+
+
+class Forwarder:
+    """Posts request bodies to ADiCT server by a pool of threads, each with its own
+    keep-alive connections.
+
+    Each request is posted to the available endpoint with the lowest expected
+    wait, see Endpoint. submit() blocks when no endpoint is available (all of
+    them reached their limit of requests in flight or are out of rotation).
+    """
+
+    def __init__(self, urls: list, concurrency: int, timeout: float, retries: int):
+        self.endpoints = [Endpoint(url, concurrency) for url in urls]
+        self.timeout = timeout
+        self.retries = retries
+        self._executor = ThreadPoolExecutor(max_workers=concurrency * len(urls))
+        # guards endpoints and stats, notified when an endpoint may be available
+        self._cond = threading.Condition()
+        self.sent = 0  # number of data-points sent
+        self.failed = 0  # number of data-points dropped after all retries
+
+    def submit(self, body: bytes, count: int):
+        """Post a JSON-encoded list of 'count' data-points (in background)."""
+        endpoint = self._acquire()
+        self._executor.submit(self._post, body, count, endpoint)
+
+    def _acquire(self) -> Endpoint:
+        """Select an endpoint for a request (wait for an available one)."""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                available = [e for e in self.endpoints if e.is_available(now)]
+                if available:
+                    endpoint = min(available, key=Endpoint.expected_wait)
+                    endpoint.in_flight += 1
+                    return endpoint
+                # wait for a finished request or the end of a cooldown
+                cooldown_ends = [
+                    e.down_until for e in self.endpoints if e.down_until > now
+                ]
+                self._cond.wait(min(cooldown_ends) - now if cooldown_ends else None)
+
+    def _switch(self, endpoint: Endpoint) -> Endpoint:
+        """Select an endpoint for a retry of a request holding a slot of the given
+        one. Never waits - if no other endpoint is available, the request stays
+        with the current one (so executor threads are never blocked by requests
+        which hold slots but are still queued in the executor)."""
+        with self._cond:
+            now = time.monotonic()
+            available = [
+                e for e in self.endpoints if e is not endpoint and e.is_available(now)
+            ]
+            if not available:
+                return endpoint
+            new = min(available, key=Endpoint.expected_wait)
+            new.in_flight += 1
+            endpoint.in_flight -= 1
+            self._cond.notify_all()
+            return new
+
+    def _release(self, endpoint: Endpoint):
+        """Free the slot of a finished request."""
+        with self._cond:
+            endpoint.in_flight -= 1
+            self._cond.notify_all()
+
+    def _record(self, endpoint: Endpoint, latency: float = None, count: int = 0):
+        """Record result of a request, latency None means it failed."""
+        with self._cond:
+            if latency is None:
+                endpoint.record_failure(time.monotonic())
+            else:
+                endpoint.record_success(latency, count)
+                self.sent += count
+
+    def _post(self, body: bytes, count: int, endpoint: Endpoint):
+        # The slot of an endpoint is held during the backoff as well, so there
+        # are never more requests in the executor than its threads
+        try:
+            delay = RETRY_BACKOFF_INITIAL
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    time.sleep(delay)
+                    delay = min(delay * 2, RETRY_BACKOFF_MAX)
+                    endpoint = self._switch(endpoint)
+                if args.verbose:
+                    print(
+                        f"Sending {count} data-points ({len(body)} bytes) "
+                        f"to {endpoint.url} ..."
+                    )
+                start = time.monotonic()
+                try:
+                    resp = get_http_session().post(
+                        endpoint.url,
+                        data=body,
+                        headers={"Content-Type": "application/json"},
+                        timeout=self.timeout,
+                    )
+                except requests.RequestException as e:
+                    self._record(endpoint)
+                    error = f"HTTP POST request failed: {e}"
+                    continue
+                latency = time.monotonic() - start
+                if args.verbose:
+                    # print max 1000 chars of response
+                    print(f"Response: ({resp.status_code}) {resp.text[:1000]}")
+                if resp.status_code == 200:
+                    self._record(endpoint, latency, count)
+                    return
+                error = f"Error response ({resp.status_code}): {resp.text[:1000]}"
+                # Other client errors mean invalid data (not a failure of the
+                # endpoint), retrying wouldn't help
+                if resp.status_code < 500 and resp.status_code != 429:
+                    self._record(endpoint, latency)
+                    break
+                self._record(endpoint)
+        finally:
+            self._release(endpoint)
+        print(f"ERROR: {error}, {count} data-points dropped", file=sys.stderr)
+        with self._cond:
+            self.failed += count
+
+    def close(self):
+        """Wait for all requests in flight."""
+        self._executor.shutdown(wait=True)
+
 
 trap = pytrap.TrapCtx()
 trap.init(["-i", args.ifcspec], 1, 0)  # ifc spec
 trap.setRequiredFmt(0, pytrap.FMT_JSON, "")
+if urls:
+    # Check the batch age regularly even if there are no data
+    trap.ifcctl(ifcidx=0, dir_in=True, request=pytrap.CTL_TIMEOUT, value=RECV_TIMEOUT)
+    batch = BatchBuilder(args.batch_size, args.batch_delay)
+    forwarder = Forwarder(urls, args.concurrency, args.timeout, args.retries)
 
 stop = False
 # Main loop (trap.stop is set to True when SIGINT or SIGTERM is received)
@@ -79,6 +477,10 @@ while not stop:
         pass
     except (pytrap.Terminated, KeyboardInterrupt):
         break
+    except pytrap.TimeoutError:
+        if batch.is_ready():
+            forwarder.submit(*batch.take())
+        continue
 
     # Check for "end-of-stream" record
     if len(data) <= 1:
@@ -86,42 +488,46 @@ while not stop:
             print("End-of-stream record received, going to quit.")
         break
 
-    try:
-        # Decode data (and check it's a valid JSON)
-        rec_list = json.loads(data.decode("utf-8"))
-    except ValueError as e:
-        print(f"ERROR: Can't decode received data: {e}", file=sys.stderr)
+    if urls and args.check != "full":
+        # Pass the message through without decoding (if possible)
+        message = pass_message(data)
+        if message is None:
+            continue
+        part, count = message
+    else:
+        rec_list = decode_message(data)
+        if rec_list is None:
+            continue
+        # Print to stdout (or send to ADiCT below)
+        if not urls:
+            print(json.dumps(rec_list, indent=args.indent))
+            continue
+        part, count = json.dumps(rec_list)[1:-1].encode(), len(rec_list)
+
+    if not part:
         continue
+    if batch.would_overflow(count):
+        forwarder.submit(*batch.take())
+    batch.add(part, count)
+    if batch.is_ready():
+        forwarder.submit(*batch.take())
 
-    # Check format - must be a list of objects
-    if not isinstance(rec_list, list) or any(
-        not isinstance(rec, dict) for rec in rec_list
-    ):
+if urls:
+    # Send the rest and wait for all requests
+    rest = batch.take()
+    if rest:
+        forwarder.submit(*rest)
+    forwarder.close()
+    if args.verbose:
         print(
-            "ERROR: Invalid format of incoming data, must be a list of objects.",
-            file=sys.stderr,
+            f"{forwarder.sent} data-points sent, "
+            f"{forwarder.failed} data-points failed to be sent"
         )
-        continue
-
-    # Add "src" tag
-    if args.src:
-        for rec in rec_list:
-            rec["src"] = args.src
-
-    # Send to ADiCT (or print to stdout)
-    if not url:
-        print(json.dumps(rec_list, indent=args.indent))
-    else:
-        to_send = json.dumps(rec_list)
-        if args.verbose:
-            print("Sending:", to_send)
-        try:
-            resp = requests.post(url=url, data=to_send)
-        except Exception as e:
-            print(f"ERROR in HTTP POST request: {e}", file=sys.stderr)
-            continue
-        if args.verbose:
-            # print max 1000 chars of response
-            print(f"Response: ({resp.status_code}) {resp.text[:1000]}")
+        for endpoint in forwarder.endpoints:
+            print(
+                f"{endpoint.url}: {endpoint.sent} data-points sent, "
+                f"average latency {endpoint.latency:.3f} s, "
+                f"limit of requests in flight {int(endpoint.limit)}"
+            )
 
 trap.finalize()
@@ -49,16 +49,22 @@ even if advised of the possibility of such damage.
 
 # Standard libraries imports
 import argparse
+import ipaddress
+import json
+import math
+import multiprocessing
+import os
+import queue
 import signal
 import sys
 import time
-from collections import namedtuple
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from functools import partial
-from itertools import islice
 from pathlib import Path
-from threading import Event, Lock, Thread
-from typing import Callable, Iterable, Iterator, Optional
+from threading import Event, Lock, Thread, local
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
 
 # NEMEA system library
 import pytrap
@@ -66,6 +72,11 @@ import pytrap
 # Third party imports
 import requests
 
+try:
+    import numpy as np
+except ImportError:
+    np = None  # NumPy is needed only for batch processing (--batch)
+
 sys.path.insert(0, str(Path(__file__).parent.parent / "common"))
 from ip_network_filter import IPNetworks
 
@@ -78,11 +89,23 @@ ATTR = "open_ports"
 ATTR_UDP = "open_ports_udp"
 HTTP_REQUEST_TIMEOUT = 10  # seconds
 DATAPOINTS_PER_REQUEST = 500
+TIME_PREFIX_CACHE_SIZE = 100000
+# Defaults of the memory-bounded UDP flow pairing (--udp-filter)
+DEFAULT_UDP_FILTER_CAPACITY = 1000000  # flows per cache rotation interval
+DEFAULT_UDP_FALSE_PAIRING_RATE = 0.001
+DEFAULT_UDP_EXACT_CACHE_SIZE = 100000
+# Validity of open_ports datapoints in ADiCT (pre/post_validity in ip.yml)
+DEFAULT_VALIDITY = 8 * 3600  # seconds
+
+# Number of flow records sent to a worker process at once (with --workers)
+WORKER_BATCH_SIZE = 1000
+# Maximum number of messages (batches) waiting in the queue of a worker process,
+# receiving of flows is blocked when reached
+WORKER_QUEUE_SIZE = 16
+# How often to check that a worker process is alive while waiting for it
+WORKER_CHECK_INTERVAL = 5  # seconds
 
 # Global variables
-# are bidirectional flows supported according to input unirec template?
-biflow_support = None
-
 stop = Event()  # a flag to signalize the program should stop (stops the sending thread)
 
 # A class (namedtuple) for simplified flow/biflow
@@ -106,6 +129,7 @@ def net_filter_networks(ip, networks_to_watch: IPNetworks):
 
 
 net_filter = net_filter_true  # default filter function
+watched_networks: Optional[IPNetworks] = None  # networks used by net_filter, if any
 
 
 # How does it work:
@@ -291,6 +315,152 @@ class BiflowAggregatorUDP(BiflowAggregator):
             return f_dstip, f_dstport, f_srcip, f_srcport
 
 
+class CountingBloomFilter:
+    """Counting Bloom filter - a set of keys with limited memory usage, supporting
+    removal of keys.
+
+    Membership test may give false positives (with probability given by the
+    requested rate if no more than 'capacity' keys are stored), never false
+    negatives as long as only keys which were added are discarded (discarding
+    a false positive would decrement counters of other keys). Counters are
+    8-bit, a saturated counter is never decremented.
+    """
+
+    def __init__(self, capacity: int, false_positive_rate: float):
+        # optimal number of counters and hash functions for given capacity and rate
+        self._size = math.ceil(
+            -capacity * math.log(false_positive_rate) / (math.log(2) ** 2)
+        )
+        self._num_hashes = max(1, round(self._size / capacity * math.log(2)))
+        self._counters = bytearray(self._size)
+        self.count = 0  # number of keys currently stored
+
+    def _indexes(self, key) -> set:
+        # Double hashing - derive all indexes from two halves of one 64-bit hash
+        # (a set, so a counter hit by more hash functions is changed just once)
+        h = hash(key) & 0xFFFFFFFFFFFFFFFF
+        h1 = h & 0xFFFFFFFF
+        h2 = (h >> 32) | 1
+        size = self._size
+        return {(h1 + i * h2) % size for i in range(self._num_hashes)}
+
+    def add(self, key):
+        counters = self._counters
+        for i in self._indexes(key):
+            if counters[i] < 255:
+                counters[i] += 1
+        self.count += 1
+
+    def __contains__(self, key) -> bool:
+        counters = self._counters
+        return all(counters[i] for i in self._indexes(key))
+
+    def discard(self, key) -> bool:
+        """Remove a key which was added before, return True if it was (probably)
+        present. Must not be called for keys which may not have been added."""
+        indexes = self._indexes(key)
+        counters = self._counters
+        if not all(counters[i] for i in indexes):
+            return False
+        for i in indexes:
+            if counters[i] < 255:
+                counters[i] -= 1
+        self.count -= 1
+        return True
+
+    def false_positive_rate(self) -> float:
+        """Estimate the current false positive rate from the counters filled."""
+        filled = self._size - self._counters.count(0)
+        return (filled / self._size) ** self._num_hashes
+
+
+class BiflowAggregatorUDPFiltered(BiflowAggregatorUDP):
+    """Memory-bounded aggregator for UDP flows.
+
+    Instead of caching every uni-flow waiting for its reverse direction, flow keys
+    are stored in a counting Bloom filter, so memory usage doesn't depend on
+    the amount of (mostly one-shot) UDP traffic, like DNS or NTP queries.
+    A flow is paired when its reverse key is found in the filter, which may
+    rarely be a false pairing (its rate is configurable and reported on every
+    cache rotation).
+
+    Only flows which can result in an open port, i.e. the server side (lower port)
+    belongs to the monitored networks, are considered at all. Time information
+    of such flows is kept in the exact cache of limited size; when it's full,
+    a paired bi-flow just gets the timestamps of the current flow.
+    """
+
+    def __init__(self, capacity: int, false_pairing_rate: float, exact_cache_size: int):
+        super().__init__()
+        self._capacity = capacity
+        self._false_pairing_rate = false_pairing_rate
+        self._exact_cache_size = exact_cache_size
+        self._filter = CountingBloomFilter(capacity, false_pairing_rate)
+        self._prev_filter = CountingBloomFilter(capacity, false_pairing_rate)
+        self._paired = 0  # number of pairings in the current interval
+
+    def rotate_cache(self):
+        """Clear the current cache and filter (should be called every few minutes)"""
+        # See BiflowAggregator.rotate_cache() about locking. Note that discard() on
+        # the (now) previous filter is safe, keys are discarded only when they were
+        # found in the exact cache, i.e. they were really added.
+        dbgprint(
+            f"UDP flow filter: {self._filter.count} unpaired flows, "
+            f"{self._paired} pairings, estimated false pairing rate: "
+            f"{self._filter.false_positive_rate():.2e}"
+        )
+        if self._filter.count > self._capacity:
+            dbgprint(
+                "WARNING: Capacity of UDP flow filter exceeded, the false pairing rate"
+                " is higher than requested. Consider increasing the capacity."
+            )
+        self._paired = 0
+        self._prev_filter = self._filter
+        self._filter = CountingBloomFilter(self._capacity, self._false_pairing_rate)
+        super().rotate_cache()
+
+    def process_flow(self, rec: pytrap.UnirecTemplate) -> Optional[Biflow]:
+        """Try to pair a flow with a previously seen one in the other direction.
+
+        Return the aggregated bi-flow or None.
+        """
+        srcip = rec.SRC_IP
+        srcport = rec.SRC_PORT
+        dstip = rec.DST_IP
+        dstport = rec.DST_PORT
+        flow_key = self.order_udp_flow_key(srcip, srcport, dstip, dstport)
+        if not net_filter(flow_key[2]):
+            # the port which would be marked as open is not monitored - skip
+            return None
+        time_first = rec.TIME_FIRST
+        time_last = rec.TIME_LAST
+        rev_key = (dstip, dstport, srcip, srcport)
+        if rev_key in self._filter or rev_key in self._prev_filter:
+            # The dst->src flow was (probably) already observed, pair them together
+            self._paired += 1
+            # Remove the key from the filter only if the pairing is confirmed by
+            # the exact cache - discarding a false positive would remove keys of
+            # other flows. Unconfirmed keys stay in the filter until its rotation.
+            reverse_flow = self._cache.pop(rev_key, None)
+            if reverse_flow is not None:
+                self._filter.discard(rev_key)
+            else:
+                reverse_flow = self._prev_cache.pop(rev_key, None)
+                if reverse_flow is not None:
+                    self._prev_filter.discard(rev_key)
+            if reverse_flow is not None:
+                c_time_first, c_time_last = reverse_flow
+                time_first = min(time_first, c_time_first)
+                time_last = max(time_last, c_time_last)
+            return Biflow(*flow_key, time_first, time_last, 0)
+        else:
+            fwd_key = (srcip, srcport, dstip, dstport)
+            self._filter.add(fwd_key)
+            if len(self._cache) < self._exact_cache_size:
+                self._cache[fwd_key] = (time_first, time_last)
+            return None
+
+
 class FoundPortCache:
     def __init__(self, well_known_filter: bool):
         self._well_known_filter = well_known_filter
@@ -339,56 +509,799 @@ class FoundPortCache:
         return to_send
 
 
-def batched(iterable: Iterable, n: int) -> Iterator[list]:
-    """Batch data into tuples of length n. The last batch may be shorter."""
-    # batched('ABCDEFG', 3) --> ABC DEF G
-    if n < 1:
-        raise ValueError("n must be at least one")
-    it = iter(iterable)
-    while True:
-        batch = list(islice(it, n))
-        if not batch:
-            break
-        yield batch
+# Sizes of UniRec field types with static size (other types are dynamic)
+UNIREC_STATIC_SIZES = {
+    "ipaddr": 16,
+    "time": 8,
+    "uint64": 8,
+    "int64": 8,
+    "double": 8,
+    "macaddr": 6,
+    "uint32": 4,
+    "int32": 4,
+    "float": 4,
+    "uint16": 2,
+    "int16": 2,
+    "uint8": 1,
+    "int8": 1,
+    "char": 1,
+}
+# Fields decoded by BatchClassifier and their NumPy types
+# (IP addresses as four 32-bit words in network byte order)
+BATCH_FIELDS = {
+    "SRC_IP": (">u4", (4,)),
+    "DST_IP": (">u4", (4,)),
+    "PROTOCOL": "u1",
+    "TCP_FLAGS": "u1",
+    "PACKETS": "=u4",
+    "PACKETS_REV": "=u4",
+}
+BATCH_VERIFY_RECORDS = 8  # number of records to check the decoded layout on
+
+
+def decode_unirec_ip(words) -> str:
+    """Convert IP address decoded by BatchClassifier into string."""
+    w0, w1, w2, w3 = (int(w) for w in words)
+    if w0 == 0 and w1 == 0 and w3 == 0xFFFFFFFF:
+        return str(ipaddress.IPv4Address(w2))
+    return str(ipaddress.IPv6Address((w0 << 96) | (w1 << 64) | (w2 << 32) | w3))
+
+
+class BatchClassifier:
+    """The first stage of flow processing done on a batch of records at once
+    (--batch).
+
+    Fields needed to decide whether a flow can indicate an open port (protocol,
+    TCP flags, packet counts, IP addresses) are decoded from the raw records
+    into NumPy arrays and all the checks are done on whole arrays. Only the
+    indexes of records which passed are returned, since most flows are dropped.
+
+    The raw records are decoded directly, according to the layout of static
+    UniRec fields. The layout is checked against values read by pytrap on the
+    first records; if it doesn't match, the fields are read by pytrap instead
+    (slower, but the checks are still vectorized).
+    """
 
+    def __init__(self, inputspec: str, udp_too: bool):
+        self._udp_too = udp_too
+        fields = [f.split() for f in inputspec.split(",")]
+        self._biflow = any(name == "PACKETS_REV" for _, name in fields)
+        # candidate layouts: order given by the template string, or sorted
+        # by size (descending) and name
+        self._candidates = [
+            self._layout(fields),
+            self._layout(
+                sorted(fields, key=lambda f: (-UNIREC_STATIC_SIZES.get(f[0], 0), f[1]))
+            ),
+        ]
+        self._dtype = None  # dtype of the verified layout (set on the first batch)
+        self._verified = False
+        self._ranges = {4: None, 6: None}
+        if watched_networks is not None:
+            self._ranges = {v: watched_networks.numeric_ranges(v) for v in (4, 6)}
 
-def post_datapoint_list(url: str, datapoints: list):
-    """Post datapoints to ADiCT server, handling possible errors."""
-    if not datapoints:
-        return
+    @staticmethod
+    def _layout(fields: list) -> Optional["np.dtype"]:
+        """Return NumPy dtype of the static part of records with fields in given
+        order, or None if some of the required fields are missing."""
+        offsets = {}
+        size = 0
+        for type_, name in fields:
+            if type_ not in UNIREC_STATIC_SIZES:
+                continue  # dynamic fields are stored after all static ones
+            offsets[name] = size
+            size += UNIREC_STATIC_SIZES[type_]
+        names = [name for name in BATCH_FIELDS if name in offsets]
+        if any(name not in offsets for name in BATCH_FIELDS if name != "PACKETS_REV"):
+            return None
+        return np.dtype(
+            {
+                "names": names,
+                "formats": [BATCH_FIELDS[name] for name in names],
+                "offsets": [offsets[name] for name in names],
+                "itemsize": size,
+            }
+        )
 
-    for batch in batched(datapoints, DATAPOINTS_PER_REQUEST):
-        try:
-            resp = requests.post(
-                url + "/datapoints",
-                json=batch,
-                timeout=HTTP_REQUEST_TIMEOUT,
+    def _verify(self, rec: pytrap.UnirecTemplate, records: list):
+        """Select the candidate layout matching the values read by pytrap."""
+        self._verified = True
+        sample = records[:BATCH_VERIFY_RECORDS]
+        for dtype in self._candidates:
+            if dtype is None:
+                continue
+            arr = self._decode(dtype, sample)
+            for data, row in zip(sample, arr):
+                rec.setData(data)
+                if any(
+                    int(row[name]) != getattr(rec, name)
+                    for name in dtype.names
+                    if not name.endswith("_IP")
+                ) or any(
+                    decode_unirec_ip(row[name]) != str(getattr(rec, name))
+                    for name in ("SRC_IP", "DST_IP")
+                ):
+                    break
+            else:
+                self._dtype = dtype
+                return
+        dbgprint(
+            "WARNING: Unexpected layout of UniRec records, batch processing will "
+            "read fields by pytrap (slower)."
+        )
+
+    @staticmethod
+    def _decode(dtype: "np.dtype", records: list) -> "np.ndarray":
+        size = dtype.itemsize
+        return np.frombuffer(b"".join([data[:size] for data in records]), dtype)
+
+    def _read_by_pytrap(self, rec: pytrap.UnirecTemplate, records: list) -> dict:
+        """Read the checked fields (except IPs) into arrays using pytrap."""
+        names = ["PROTOCOL", "TCP_FLAGS", "PACKETS"]
+        if self._biflow:
+            names.append("PACKETS_REV")
+        values = {name: [] for name in names}
+        for data in records:
+            rec.setData(data)
+            for name in names:
+                values[name].append(getattr(rec, name))
+        return {
+            name: np.array(vals, dtype=BATCH_FIELDS[name])
+            for name, vals in values.items()
+        }
+
+    def _in_networks(self, words: "np.ndarray") -> Optional["np.ndarray"]:
+        """Return mask of IP addresses (decoded words) in the watched networks,
+        or None if it can't be computed."""
+        if self._ranges[4] is None or self._ranges[6] is None:
+            return None
+        w0, w1, w2, w3 = (words[:, i].astype(np.uint64) for i in range(4))
+        is_ipv4 = (w0 == 0) & (w1 == 0) & (w3 == 0xFFFFFFFF)
+        mask = np.zeros(len(words), dtype=bool)
+        for first, last in self._ranges[4]:
+            mask |= is_ipv4 & (w2 >= first) & (w2 <= last)
+        if self._ranges[6]:
+            # compare 128-bit addresses as (high, low) pairs of 64-bit integers
+            hi = (w0 << np.uint64(32)) | w1
+            lo = (w2 << np.uint64(32)) | w3
+            for first, last in self._ranges[6]:
+                f_hi, f_lo = np.uint64(first >> 64), np.uint64(first & (2**64 - 1))
+                l_hi, l_lo = np.uint64(last >> 64), np.uint64(last & (2**64 - 1))
+                mask |= (
+                    ~is_ipv4
+                    & ((hi > f_hi) | ((hi == f_hi) & (lo >= f_lo)))
+                    & ((hi < l_hi) | ((hi == l_hi) & (lo <= l_lo)))
+                )
+        return mask
+
+    def classify(
+        self, rec: pytrap.UnirecTemplate, records: list
+    ) -> Tuple[List[int], List[bool], bool]:
+        """Check a batch of raw records.
+
+        Return a tuple: (
+            indexes of records which passed,
+            for each record, whether it's a bi-flow with both directions filled,
+            whether the records were already checked against the watched networks
+        )
+        """
+        if not self._verified:
+            self._verify(rec, records)
+        if self._dtype is not None:
+            arr = self._decode(self._dtype, records)
+        else:
+            arr = self._read_by_pytrap(rec, records)
+
+        protocol = arr["PROTOCOL"]
+        # TCP with SYN and ACK flags (see FlowProcessor.process_record)
+        mask = (protocol == 6) & ((arr["TCP_FLAGS"] & 0x12) == 0x12)
+        if self._udp_too:
+            mask |= protocol == 17
+        if self._biflow:
+            is_biflow = (arr["PACKETS"] > 0) & (arr["PACKETS_REV"] > 0)
+        else:
+            is_biflow = np.zeros(len(records), dtype=bool)
+
+        networks_checked = False
+        if watched_networks is None:
+            networks_checked = True
+        elif self._dtype is not None:
+            src_in = self._in_networks(arr["SRC_IP"])
+            if src_in is not None:
+                mask &= src_in | self._in_networks(arr["DST_IP"])
+                networks_checked = True
+        return np.flatnonzero(mask).tolist(), is_biflow.tolist(), networks_checked
+
+
+class FlowProcessor:
+    """Detection of open ports from flow records - pairing of uni-flows and
+    storing of found open ports into the port caches."""
+
+    def __init__(self, args: argparse.Namespace, inputspec: str):
+        self.udp_too = args.udp_too
+        self.batch = args.batch
+        # are bidirectional flows supported according to input unirec template?
+        self.biflow_support = None
+        self.classifier = (
+            BatchClassifier(inputspec, args.udp_too) if self.batch else None
+        )
+        self.biflow_aggregator = BiflowAggregator()
+        if args.udp_too and args.udp_filter:
+            self.biflow_aggregator_udp = BiflowAggregatorUDPFiltered(
+                args.udp_filter_capacity,
+                args.udp_false_pairing_rate,
+                args.udp_exact_cache_size,
             )
-        except requests.ConnectionError as e:
-            dbgprint(f"Send failed due to ConnectionError: {e}")
-            continue
-        except requests.Timeout:
-            dbgprint("Send failed due to timeout.")
-            continue
+        else:
+            self.biflow_aggregator_udp = BiflowAggregatorUDP()
+        self.tcp_ports = FoundPortCache(well_known_filter=not args.no_port_filter)
+        self.udp_ports = FoundPortCache(well_known_filter=not args.no_port_filter)
+
+    def start_cache_rotation_threads(self, interval: int):
+        # Start a separate thread for cache rotation in biflow_aggregator (make it a
+        # daemon thread, so it's automatically joined/killed when the main thread
+        # exits)
+        self.biflow_aggregator.start_cache_rotation_thread(interval)
+        if self.udp_too:
+            self.biflow_aggregator_udp.start_cache_rotation_thread(interval)
+
+    def reset_format(self, inputspec: str):
+        """Should be called when the input format changes."""
+        self.biflow_support = None
+        if self.batch:
+            self.classifier = BatchClassifier(inputspec, self.udp_too)
+
+    def process_records(self, rec: pytrap.UnirecTemplate, records: list):
+        """Process a list of raw (bi)flow records (in a batch, if enabled)."""
+        if not self.batch:
+            for data in records:
+                rec.setData(data)
+                self.process_record(rec)
+            return
 
-        if resp.status_code == 200:
-            dbgprint(
-                f"{len(batch)} datapoints successfully sent.",
+        indexes, is_biflow, networks_checked = self.classifier.classify(rec, records)
+        for i in indexes:
+            rec.setData(records[i])
+            if (
+                not networks_checked
+                and not net_filter(rec.SRC_IP)
+                and not net_filter(rec.DST_IP)
+            ):
+                continue
+            if rec.PROTOCOL == 6:
+                self.process_tcp_flow(rec, is_biflow[i])
+            else:
+                self.process_udp_flow(rec, is_biflow[i])
+
+    def process_record(self, rec: pytrap.UnirecTemplate):
+        """Process a (bi)flow record, store found open port, if any."""
+        # Autodetect if bi-flow are supported
+        if self.biflow_support is None:
+            try:
+                _ = rec.PACKETS_REV
+                self.biflow_support = True
+                dbgprint("Bi-flow support detected")
+            except AttributeError:
+                self.biflow_support = False
+                dbgprint("Bi-flow support not detected")
+
+        if not net_filter(rec.SRC_IP) and not net_filter(rec.DST_IP):
+            # neither SRC_IP nor DST_IP belong to the set of monitored prefixes - skip
+            return
+
+        if rec.PROTOCOL == 6 and rec.TCP_FLAGS & 0x12 == 0x12:
+            # TCP, SYN and ACK flags set
+            # If there is no SYN flag, it's probably a continuation of a longer flow.
+            # We can't use this, as in this case it's not possible to determine which
+            # side initiated the connection from the flow timestamps. We also require
+            # ACK flag, as each successfully opened TCP connection requires both SYN
+            # and ACK flags in both directions.
+
+            # Detect if this flow is proper biflow (with both directions filled)
+            self.process_tcp_flow(
+                rec, self.biflow_support and rec.PACKETS > 0 and rec.PACKETS_REV > 0
+            )
+        elif self.udp_too and rec.PROTOCOL == 17:
+            # UDP
+            self.process_udp_flow(
+                rec, self.biflow_support and rec.PACKETS > 0 and rec.PACKETS_REV > 0
+            )
+
+    def process_tcp_flow(self, rec: pytrap.UnirecTemplate, is_biflow: bool):
+        """Process a TCP flow which passed all the checks."""
+        if is_biflow:
+            # it's biflow - parse needed information and detect open port
+            biflow = Biflow(
+                rec.SRC_IP,
+                rec.SRC_PORT,
+                rec.DST_IP,
+                rec.DST_PORT,
+                rec.TIME_FIRST,
+                rec.TIME_LAST,
+                rec.TCP_FLAGS,
+            )
+            self.tcp_ports.process_biflow(biflow)
+        else:
+            # It's uniflow - try to aggregate it, if successful, detect open port
+            biflow = self.biflow_aggregator.process_flow(rec)
+            if biflow:
+                self.tcp_ports.process_biflow(biflow)
+
+    def process_udp_flow(self, rec: pytrap.UnirecTemplate, is_biflow: bool):
+        """Process a UDP flow which passed all the checks."""
+        if is_biflow:
+            # it's biflow - parse needed information and detect open port
+            biflow = Biflow(
+                *self.biflow_aggregator_udp.order_udp_flow_key(
+                    rec.SRC_IP, rec.SRC_PORT, rec.DST_IP, rec.DST_PORT
+                ),
+                rec.TIME_FIRST,
+                rec.TIME_LAST,
+                0,
             )
+            self.udp_ports.process_biflow(biflow)
         else:
+            # It's uniflow - try to aggregate it, if successful, detect open port
+            biflow = self.biflow_aggregator_udp.process_flow(rec)
+            if biflow:
+                self.udp_ports.process_biflow(biflow)
+
+
+# Multi-process mode (--workers N):
+# The main process only receives flow records, drops those which can't indicate
+# an open port (the cheap checks of protocol, TCP flags and networks, or
+# BatchClassifier with --batch) and dispatches the rest to worker
+# processes by a direction-symmetric hash of the (IP, port) endpoints, so both
+# uni-flows of a connection always reach the same worker (and its biflow
+# aggregator). Each worker has its own FlowProcessor, i.e. its own port caches.
+# When data are to be sent, the sender thread collects the port caches from all
+# workers and merges them (the same IP:port may have been found by more workers).
+#
+# Messages sent to a worker (via its own queue) are tuples (command, argument):
+#   ("data", list of raw records), ("fmt", new unirec template spec),
+#   ("collect", attr) - worker replies (via its own out queue) with content
+#                       of the port cache for 'attr',
+#   ("stop", None)
+
+
+def worker_process_func(
+    args: argparse.Namespace,
+    inputspec: str,
+    in_queue: multiprocessing.Queue,
+    out_queue: multiprocessing.Queue,
+):
+    """Main function of a worker process (see above)."""
+    # Signals are handled by the main process, which stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    rec = pytrap.UnirecTemplate(inputspec)
+    processor = FlowProcessor(args, inputspec)
+    processor.start_cache_rotation_threads(args.cache_rotation)
+    port_caches = {ATTR: processor.tcp_ports, ATTR_UDP: processor.udp_ports}
+    while True:
+        command, arg = in_queue.get()
+        if command == "data":
+            processor.process_records(rec, arg)
+        elif command == "fmt":
+            rec = pytrap.UnirecTemplate(arg)
+            processor.reset_format(arg)
+        elif command == "collect":
+            # Convert to picklable types
+            open_ports = {
+                (str(ip), port): (
+                    val["t1"].getTimeAsFloat(),
+                    val["t2"].getTimeAsFloat(),
+                    val["conns"],
+                )
+                for (ip, port), val in port_caches[arg].get_to_send_and_clear().items()
+            }
+            out_queue.put(open_ports)
+        elif command == "stop":
+            return
+
+
+class WorkerPool:
+    """Pool of worker processes processing flow records (see above)."""
+
+    def __init__(self, args: argparse.Namespace, inputspec: str):
+        ctx = multiprocessing.get_context("fork")
+        self._udp_too = args.udp_too
+        self._classifier = (
+            BatchClassifier(inputspec, args.udp_too) if args.batch else None
+        )
+        # the queues are bounded, so a slow worker slows down receiving of flows
+        # instead of filling the memory
+        self._in_queues = [ctx.Queue(WORKER_QUEUE_SIZE) for _ in range(args.workers)]
+        self._out_queues = [ctx.Queue() for _ in range(args.workers)]
+        self._pending = [[] for _ in range(args.workers)]
+        # pending records are flushed by the main thread and by sender threads
+        # (before collecting), lock to avoid race conditions
+        self._pending_lock = Lock()
+        # only one collection of results at a time (TCP and UDP sender threads)
+        self._collect_lock = Lock()
+        self._dead = set()  # workers found dead (their messages are dropped)
+        self._workers = [
+            ctx.Process(
+                target=worker_process_func,
+                args=(args, inputspec, in_queue, out_queue),
+                daemon=True,
+            )
+            for in_queue, out_queue in zip(self._in_queues, self._out_queues)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def process_record(self, rec: pytrap.UnirecTemplate, data: bytes):
+        """Pass a flow record (already set to 'rec') to a worker, unless it fails
+        the first checks of FlowProcessor.process_record."""
+        protocol = rec.PROTOCOL
+        if not (
+            (protocol == 6 and rec.TCP_FLAGS & 0x12 == 0x12)
+            or (self._udp_too and protocol == 17)
+        ):
+            return
+        if not net_filter(rec.SRC_IP) and not net_filter(rec.DST_IP):
+            return
+        self._dispatch(rec, data)
+
+    def process_records(self, rec: pytrap.UnirecTemplate, records: list):
+        """Pass the raw flow records which pass the checks of BatchClassifier
+        to workers (--batch)."""
+        indexes, _, networks_checked = self._classifier.classify(rec, records)
+        for i in indexes:
+            rec.setData(records[i])
+            if (
+                not networks_checked
+                and not net_filter(rec.SRC_IP)
+                and not net_filter(rec.DST_IP)
+            ):
+                continue
+            self._dispatch(rec, records[i])
+
+    def _dispatch(self, rec: pytrap.UnirecTemplate, data: bytes):
+        """Pass a flow record to the worker given by a hash of its endpoints."""
+        # XOR of hashes of both endpoints is the same for both directions
+        h = hash((rec.SRC_IP, rec.SRC_PORT)) ^ hash((rec.DST_IP, rec.DST_PORT))
+        i = h % len(self._pending)
+        with self._pending_lock:
+            pending = self._pending[i]
+            pending.append(data)
+            if len(pending) >= WORKER_BATCH_SIZE:
+                self._put(i, ("data", pending))
+                self._pending[i] = []
+
+    def flush(self):
+        """Pass all pending flow records to workers."""
+        with self._pending_lock:
+            for i, pending in enumerate(self._pending):
+                if pending:
+                    self._put(i, ("data", pending))
+                    self._pending[i] = []
+
+    def set_format(self, inputspec: str):
+        """Announce new input format to workers."""
+        self.flush()
+        if self._classifier is not None:
+            self._classifier = BatchClassifier(inputspec, self._udp_too)
+        for i in range(len(self._workers)):
+            self._put(i, ("fmt", inputspec))
+
+    def collect(self, attr: str) -> dict:
+        """Get and clear the content of the port caches for 'attr' of all workers,
+        merged into one dict (ip,port)->{"t1","t2","conns"}.
+
+        If a worker process has died, its port caches are lost - an error is
+        printed and the module is stopped.
+        """
+        merged = {}
+        with self._collect_lock:
+            # Records received so far belong to this send interval
+            self.flush()
+            for i in range(len(self._workers)):
+                self._put(i, ("collect", attr))
+            for worker, out_queue in zip(self._workers, self._out_queues):
+                open_ports = self._get_reply(worker, out_queue)
+                if open_ports is None:
+                    continue
+                for key, (t1, t2, conns) in open_ports.items():
+                    rec = merged.get(key)
+                    if rec is None:
+                        merged[key] = {"t1": t1, "t2": t2, "conns": conns}
+                    else:
+                        rec["t1"] = min(rec["t1"], t1)
+                        rec["t2"] = max(rec["t2"], t2)
+                        rec["conns"] += conns
+        for rec in merged.values():
+            rec["t1"] = pytrap.UnirecTime(rec["t1"])
+            rec["t2"] = pytrap.UnirecTime(rec["t2"])
+        return merged
+
+    def _put(self, i: int, message: tuple):
+        """Put a message to the queue of the i-th worker, waiting while the queue
+        is full. The message is dropped if the worker is dead."""
+        while self._workers[i] not in self._dead:
+            try:
+                self._in_queues[i].put(message, timeout=WORKER_CHECK_INTERVAL)
+                return
+            except queue.Full:
+                if self._is_dead(self._workers[i]):
+                    return
+
+    def _get_reply(
+        self, worker: multiprocessing.Process, out_queue: multiprocessing.Queue
+    ) -> Optional[dict]:
+        """Wait for a reply of the worker, return None if the worker is dead."""
+        while worker not in self._dead:
+            try:
+                return out_queue.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                if self._is_dead(worker):
+                    return None
+        return None
+
+    def _is_dead(self, worker: multiprocessing.Process) -> bool:
+        """Check the worker is alive, stop the module if it isn't (its data are
+        lost)."""
+        if worker.is_alive():
+            return False
+        self._dead.add(worker)
+        dbgprint(
+            f"ERROR: Worker process {worker.pid} died "
+            f"(exit code {worker.exitcode}), stopping."
+        )
+        stop.set()
+        return True
+
+    def stop(self):
+        """Stop all workers (pending records are processed first)."""
+        for i, (in_queue, worker) in enumerate(zip(self._in_queues, self._workers)):
+            self._put(i, ("stop", None))
+            if not worker.is_alive():
+                # Nobody reads the queue, don't wait for it to be written at exit
+                in_queue.cancel_join_thread()
+        for worker in self._workers:
+            worker.join()
+
+
+class WorkerPortCache:
+    """Port cache of a WorkerPool, to be passed to sender functions instead
+    of a FoundPortCache."""
+
+    def __init__(self, pool: WorkerPool, attr: str):
+        self._pool = pool
+        self._attr = attr
+
+    def get_to_send_and_clear(self):
+        """Return the content of the caches in all workers and clear them."""
+        return self._pool.collect(self._attr)
+
+
+class SentPortIndex:
+    """Index of open ports already sent to ADiCT, used to suppress re-sending.
+
+    ADiCT keeps each open_ports datapoint valid for several hours, so there is no
+    need to send the same (ip, port) on every send interval. A port is sent again
+    only when its newest observation (t2) is at least 'refresh_fraction' of the
+    validity window past the t2 of the last datapoint sent for it. This also covers
+    ports re-appearing after a gap - their t2 is then far from the last sent one.
+
+    The index is kept in a JSON file (if a path is given), so it survives restarts.
+    """
+
+    def __init__(
+        self, validity: float, refresh_fraction: float, path: Optional[str] = None
+    ):
+        self._validity = validity
+        self._refresh_interval = validity * refresh_fraction
+        self._path = path
+        # dict (attr,ip,port)->t2 of the last datapoint sent (as epoch seconds)
+        self._sent = {}
+        # number of suppressed datapoints of each attribute (since the last report)
+        self._suppressed = Counter()
+        # used by both sender threads (TCP and UDP), lock to avoid race conditions
+        self._lock = Lock()
+        # both sender threads save the index (using the same temporary file)
+        self._save_lock = Lock()
+
+    def should_send(self, attr: str, ip: str, port: int, t2: float) -> bool:
+        """Return True if the datapoint should be sent (and mark it as sent)."""
+        key = (attr, ip, port)
+        with self._lock:
+            last_t2 = self._sent.get(key)
+            if last_t2 is not None and t2 - last_t2 < self._refresh_interval:
+                self._suppressed[attr] += 1
+                return False
+            self._sent[key] = t2
+            return True
+
+    def forget(self, keys: Iterable[tuple]):
+        """Remove (attr,ip,port) keys of datapoints which failed to be sent, so they
+        are sent next time."""
+        with self._lock:
+            for key in keys:
+                self._sent.pop(key, None)
+
+    def pop_suppressed(self, attr: str) -> int:
+        """Return the number of datapoints of 'attr' suppressed since the last call."""
+        with self._lock:
+            return self._suppressed.pop(attr, 0)
+
+    def load(self):
+        """Load the index from file (if it exists)."""
+        if not self._path or not os.path.exists(self._path):
+            return
+        with open(self._path) as f:
+            entries = json.load(f)
+        with self._lock:
+            self._sent = {(attr, ip, port): t2 for attr, ip, port, t2 in entries}
+        dbgprint(f"Loaded {len(self._sent)} entries of sent ports index.")
+
+    def save(self):
+        """Drop expired entries and write the index to file (if path is set)."""
+        # Whole saving is serialized, so a newer index is never overwritten
+        # by an older one and the temporary file isn't written by both threads
+        with self._save_lock:
+            expired_before = time.time() - self._validity
+            with self._lock:
+                self._sent = {
+                    k: t2 for k, t2 in self._sent.items() if t2 >= expired_before
+                }
+                entries = [[*key, t2] for key, t2 in self._sent.items()]
+            if not self._path:
+                return
+            # Write to a temporary file first, so the index is never left
+            # half-written
+            tmp_path = self._path + ".tmp"
+            try:
+                with open(tmp_path, "w") as f:
+                    json.dump(entries, f)
+                os.replace(tmp_path, self._path)
+            except OSError as e:
+                dbgprint(f"WARNING: Can't save index of sent ports: {e}")
+
+
+sent_index: Optional[SentPortIndex] = None  # set in main() if suppression is enabled
+
+
+def format_time(t: pytrap.UnirecTime) -> str:
+    """Format time in ISO format needed for ADiCT (YYYY-MM-DDThh:mm:ss.fff)."""
+    seconds = t.getSeconds()
+    # Formatting of the date and time part is cached, timestamps within a send
+    # interval share just a few hundreds of distinct seconds
+    prefix = _time_prefix_cache.get(seconds)
+    if prefix is None:
+        if len(_time_prefix_cache) >= TIME_PREFIX_CACHE_SIZE:
+            _time_prefix_cache.clear()
+        prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds))
+        _time_prefix_cache[seconds] = prefix
+    return f"{prefix}.{t.getMiliSeconds():03d}"
+
+
+_time_prefix_cache = {}  # seconds -> formatted date and time
+
+
+def get_http_session() -> requests.Session:
+    """Return HTTP session (with keep-alive connections) of the current thread."""
+    session = getattr(_thread_local, "http_session", None)
+    if session is None:
+        session = _thread_local.http_session = requests.Session()
+    return session
+
+
+_thread_local = local()
+
+
+def iter_open_ports(to_send: dict, attr: str) -> Iterator[tuple]:
+    """Take entries out of the dict of found open ports (emptying it gradually)
+    and yield those which should be sent as (ip, port, t1, t2, conns) tuples,
+    with IP as string and times formatted."""
+    while to_send:
+        (ip, port), val = to_send.popitem()
+        ip = str(ip)
+        if val["t2"] < val["t1"]:  # shouldn't happen, but... just in case
             dbgprint(
-                f"Error when trying to send datapoints ({resp.status_code}): "
-                f"{resp.text}",
+                f"WARNING: time_last < time_first, this shouldn't be possible "
+                f"(unless a flow with wrong timestamps was received)! "
+                f"The record will be dropped. Details: "
+                f"ip={ip}, port={port}, time_first={format_time(val['t1'])}, "
+                f"time_last={format_time(val['t2'])}",
             )
+            continue
+        if sent_index is not None and not sent_index.should_send(
+            attr, ip, port, val["t2"].getTimeAsFloat()
+        ):
+            continue
+        yield ip, port, format_time(val["t1"]), format_time(val["t2"]), val["conns"]
+
+
+def serialize_batches(
+    open_ports: Iterable[tuple], srctag: str, attr: str
+) -> Iterator[Tuple[bytes, list]]:
+    """Convert open ports into JSON-encoded lists of datapoints, up to
+    DATAPOINTS_PER_REQUEST in each one.
+
+    Yield tuples (encoded batch, list of (attr,ip,port) keys of the datapoints).
+    """
+    # Everything except IP, port and times is the same for all datapoints
+    # (IP address and formatted times never contain characters needing escaping)
+    type_json, attr_json, src_json = (json.dumps(v) for v in (TYPE, attr, srctag))
+    parts = []
+    keys = []
+    for ip, port, t1, t2, _conns in open_ports:
+        parts.append(
+            f'{{"type":{type_json},"id":"{ip}","attr":{attr_json},"v":{port},'
+            f'"t1":"{t1}","t2":"{t2}","src":{src_json}}}'
+        )
+        keys.append((attr, ip, port))
+        if len(parts) >= DATAPOINTS_PER_REQUEST:
+            yield ("[" + ",".join(parts) + "]").encode(), keys
+            parts = []
+            keys = []
+    if parts:
+        yield ("[" + ",".join(parts) + "]").encode(), keys
+
+
+def post_batch(url: str, body: bytes, count: int) -> bool:
+    """Post a JSON-encoded list of datapoints to ADiCT server, handling possible
+    errors. Return True on success."""
+    try:
+        resp = get_http_session().post(
+            url + "/datapoints",
+            data=body,
+            headers={"Content-Type": "application/json"},
+            timeout=HTTP_REQUEST_TIMEOUT,
+        )
+    except requests.ConnectionError as e:
+        dbgprint(f"Send failed due to ConnectionError: {e}")
+        return False
+    except requests.Timeout:
+        dbgprint("Send failed due to timeout.")
+        return False
+
+    if resp.status_code == 200:
+        dbgprint(
+            f"{count} datapoints successfully sent.",
+        )
+        return True
+    dbgprint(
+        f"Error when trying to send datapoints ({resp.status_code}): {resp.text}",
+    )
+    return False
+
+
+def post_batches(url: str, batches: Iterator[Tuple[bytes, list]]) -> list:
+    """Post batches of datapoints to ADiCT server.
+
+    Each batch is posted (by a helper thread) while the next one is being
+    prepared, so at most two batches are held in memory at once.
+
+    Return the list of keys of datapoints which failed to be sent.
+    """
+    failed = []
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = None  # (future, keys) of the batch being posted
+        for body, keys in batches:
+            future = executor.submit(post_batch, url, body, len(keys))
+            if pending is not None and not pending[0].result():
+                failed.extend(pending[1])
+            pending = (future, keys)
+        if pending is not None and not pending[0].result():
+            failed.extend(pending[1])
+    return failed
 
 
 def send_datapoints(ports: FoundPortCache, url: str, srctag: str, attr: str):
     """Send data about open ports (in found_open_ports dict) as data-points.
 
     The found_open_ports dict is cleared after the data are send.
+    Datapoints are created and sent gradually, in batches, while the entries
+    are being removed from the dict.
 
     If URL is not given, print basic info to stdout.
 
+    If suppression of repeated datapoints is enabled (global sent_index is set),
+    ports already sent recently enough are skipped.
+
     Parameters
     -----------
     ports : FoundPortCache
@@ -403,40 +1316,22 @@ def send_datapoints(ports: FoundPortCache, url: str, srctag: str, attr: str):
     to_send = ports.get_to_send_and_clear()
 
     dbgprint("Sending open ports...")
-    datapoints = []
-    for key, val in to_send.items():
-        ip, port = key
-        # ISO format needed for ADiCT (YYYY-MM-DDThh:mm:ss[.fff][Z])
-        t1 = val["t1"].toDatetime().isoformat()
-        t2 = val["t2"].toDatetime().isoformat()
-        conns = val["conns"]
-
-        if t2 < t1:  # shouldn't happen, but... just in case
-            dbgprint(
-                f"WARNING: time_last < time_first, this shouldn't be possible "
-                f"(unless a flow with wrong timestamps was received)! "
-                f"The record will be dropped. Details: "
-                f"ip={ip}, port={port}, time_first={t1}, time_last={t2}",
-            )
-            continue
-
-        datapoint = {
-            "type": TYPE,
-            "id": str(ip),
-            "attr": attr,
-            "v": port,
-            "t1": t1,
-            "t2": t2,
-            "src": srctag,
-        }
-        if url:
-            datapoints.append(datapoint)
-        else:
-            # just print, don't send anywhere
+    open_ports = iter_open_ports(to_send, attr)
+    if url:
+        failed = post_batches(url, serialize_batches(open_ports, srctag, attr))
+        if sent_index is not None and failed:
+            sent_index.forget(failed)
+    else:
+        # just print, don't send anywhere
+        for ip, port, t1, t2, conns in open_ports:
             print(f"{ip}:{port}  {t1} - {t2} ({conns}x)")
 
-    if url:
-        post_datapoint_list(url, datapoints)
+    if sent_index is not None:
+        sent_index.save()
+        dbgprint(
+            f"{sent_index.pop_suppressed(attr)} datapoints suppressed "
+            "(sent recently).",
+        )
 
     dbgprint("Done.")
 
@@ -473,24 +1368,31 @@ def sender_thread_func(
         send_datapoints(ports=ports, url=url, srctag=srctag, attr=attr)
 
 
-def create_network_filter(
+def load_networks(
     networks: Optional[str],
     networks_file: Optional[str],
     verbose: Optional[bool] = False,
-) -> Callable:
-    """Load networks passed via arguments or a file, return filtering function"""
+) -> Optional[IPNetworks]:
+    """Load networks passed via arguments or a file (None if neither is given)"""
     if networks:
         networks_to_watch = IPNetworks.from_list(networks.replace(",", " ").split())
     elif networks_file:
         networks_to_watch = IPNetworks.from_file(networks_file)
     else:
-        return net_filter_true
+        return None
 
     if verbose:
         dbgprint(
             "Only IPs from these networks will be watched for open ports:",
         )
         dbgprint(",".join(map(str, networks_to_watch.networks)))
+    return networks_to_watch
+
+
+def create_network_filter(networks_to_watch: Optional[IPNetworks]) -> Callable:
+    """Return filtering function for given networks"""
+    if networks_to_watch is None:
+        return net_filter_true
     return partial(net_filter_networks, networks_to_watch=networks_to_watch)
 
 
@@ -506,9 +1408,34 @@ def signal_handler(sig, frame):
     signal.signal(signal.SIGABRT, signal.SIG_DFL)
 
 
+def check_args(args: argparse.Namespace) -> Optional[str]:
+    """Check values of the command-line arguments, return error message or None."""
+    checks = [
+        (args.cache_rotation >= 1, "Cache rotation interval must be at least 1 second"),
+        (args.send_interval >= 1, "Send interval must be at least 1 second"),
+        (
+            0.0 <= args.refresh_fraction <= 1.0,
+            "Refresh fraction must be between 0 and 1",
+        ),
+        (args.udp_filter_capacity >= 1, "UDP filter capacity must be at least 1"),
+        (
+            0.0 < args.udp_false_pairing_rate < 1.0,
+            "UDP false pairing rate must be between 0 and 1",
+        ),
+        (not args.udp_filter or args.udp_too, "--udp-filter requires --udp-too"),
+        (args.workers >= 0, "Number of workers must not be negative"),
+        (args.batch >= 0, "Batch size must not be negative"),
+        (not args.batch or np is not None, "NumPy is required for --batch"),
+    ]
+    for ok, error in checks:
+        if not ok:
+            return error
+    return None
+
+
 def main():
     """Main function of the module."""
-    global biflow_support, net_filter
+    global net_filter, watched_networks, sent_index
 
     parser = argparse.ArgumentParser(
         description="Analyze IP flows to get information about open ports on each IP "
@@ -583,6 +1510,37 @@ def main():
         default=False,
         help="Also detect open UDP ports (experimental, not fully supported)",
     )
+    parser.add_argument(
+        "--udp-filter",
+        action="store_true",
+        default=False,
+        help="Pair UDP uni-flows using a probabilistic filter with bounded memory "
+        "usage instead of caching all of them (only with --udp-too)",
+    )
+    parser.add_argument(
+        "--udp-filter-capacity",
+        type=int,
+        metavar="N",
+        default=DEFAULT_UDP_FILTER_CAPACITY,
+        help="Expected number of unpaired UDP flows per cache rotation interval, "
+        f"sets the size of the filter (default: {DEFAULT_UDP_FILTER_CAPACITY})",
+    )
+    parser.add_argument(
+        "--udp-false-pairing-rate",
+        type=float,
+        metavar="RATE",
+        default=DEFAULT_UDP_FALSE_PAIRING_RATE,
+        help="Requested rate of falsely paired UDP flows "
+        f"(default: {DEFAULT_UDP_FALSE_PAIRING_RATE})",
+    )
+    parser.add_argument(
+        "--udp-exact-cache-size",
+        type=int,
+        metavar="N",
+        default=DEFAULT_UDP_EXACT_CACHE_SIZE,
+        help="Maximum number of UDP flows with exact timestamps kept for pairing "
+        f"(default: {DEFAULT_UDP_EXACT_CACHE_SIZE})",
+    )
     parser.add_argument(
         "--no-port-filter",
         action="store_true",
@@ -591,25 +1549,77 @@ def main():
         "ports. This is enabled by default due to inaccuracies in flow "
         "timestamps, which can lead to reversed flows like this.",
     )
+    parser.add_argument(
+        "--refresh-fraction",
+        type=float,
+        metavar="FRACTION",
+        default=0.0,
+        help="Suppress re-sending of already sent open ports. A port is sent again "
+        "only after this fraction of the datapoint validity window (see "
+        "--validity) has passed since it was sent last time. "
+        "Default: 0 (no suppression, send all ports every send interval)",
+    )
+    parser.add_argument(
+        "--validity",
+        type=int,
+        metavar="SECONDS",
+        default=DEFAULT_VALIDITY,
+        help="Validity of open port datapoints in ADiCT, i.e. pre/post_validity "
+        f"of the attribute (in seconds, default: {DEFAULT_VALIDITY})",
+    )
+    parser.add_argument(
+        "--sent-index-file",
+        metavar="FILE",
+        help="File to store the index of sent ports into, so the suppression of "
+        "repeated datapoints works across restarts (only with --refresh-fraction)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        metavar="N",
+        default=0,
+        help="Process flows in N worker processes. Flows are distributed by a hash "
+        "of their endpoints, so both directions of a connection are processed "
+        "by the same worker. Default: 0 (process flows in the main process)",
+    )
+    parser.add_argument(
+        "--batch",
+        type=int,
+        metavar="N",
+        default=0,
+        help="Process flow records in batches of N records, the first checks are "
+        "done on whole batches using NumPy. Default: 0 (process records one by one)",
+    )
     args = parser.parse_args()
 
-    if args.cache_rotation < 1:
-        print(
-            "ERROR: Cache rotation interval must be at least 1 second", file=sys.stderr
-        )
-        return 1
-    if args.send_interval < 1:
-        print("ERROR: Send interval must be at least 1 second", file=sys.stderr)
+    error = check_args(args)
+    if error:
+        print(f"ERROR: {error}", file=sys.stderr)
         return 1
 
+    if args.refresh_fraction > 0:
+        sent_index = SentPortIndex(
+            args.validity, args.refresh_fraction, args.sent_index_file
+        )
+        try:
+            sent_index.load()
+        except (OSError, ValueError, TypeError) as e:
+            # Not fatal, the ports are just sent again
+            print(
+                f"WARNING: Can't load index of sent ports, starting with an empty "
+                f"one: {e}",
+                file=sys.stderr,
+            )
+
     # Parse networks and create a filter function
     try:
-        net_filter = create_network_filter(
+        watched_networks = load_networks(
             args.networks, args.networks_file, verbose=True
         )
     except ValueError as e:
         print(f"ERROR: {e}", file=sys.stderr)
         return 1
+    net_filter = create_network_filter(watched_networks)
 
     trap = pytrap.TrapCtx()
     trap.init(sys.argv, 1, 0)  # argv, ifcin - 1 input IFC, ifcout - 0 output IFC
@@ -624,9 +1634,6 @@ def main():
     trap.setRequiredFmt(0, pytrap.FMT_UNIREC, inputspec)
     rec = pytrap.UnirecTemplate(inputspec)
 
-    biflow_aggregator = BiflowAggregator()
-    biflow_aggregator_udp = BiflowAggregatorUDP()
-
     if args.url:
         # Strip any trailing slash from the URL
         args.url = args.url.rstrip("/")
@@ -650,14 +1657,18 @@ def main():
     signal.signal(signal.SIGTERM, signal_handler)
     signal.signal(signal.SIGABRT, signal_handler)
 
-    tcp_ports = FoundPortCache(well_known_filter=not args.no_port_filter)
-    udp_ports = FoundPortCache(well_known_filter=not args.no_port_filter)
-
-    # Start a separate thread for cache rotation in biflow_aggregator (make it a
-    # daemon thread, so it's automatically joined/killed when the main thread exits)
-    biflow_aggregator.start_cache_rotation_thread(args.cache_rotation)
-    if args.udp_too:
-        biflow_aggregator_udp.start_cache_rotation_thread(args.cache_rotation)
+    if args.workers:
+        # Flows are processed by worker processes (must be started before any other
+        # thread), found open ports are collected from them when data are sent
+        processor = None
+        pool = WorkerPool(args, inputspec)
+        tcp_ports = WorkerPortCache(pool, ATTR)
+        udp_ports = WorkerPortCache(pool, ATTR_UDP)
+    else:
+        processor = FlowProcessor(args, inputspec)
+        processor.start_cache_rotation_threads(args.cache_rotation)
+        tcp_ports = processor.tcp_ports
+        udp_ports = processor.udp_ports
 
     # Start a separate thread for sending out data about found open ports
     sender_thread = Thread(
@@ -673,91 +1684,62 @@ def main():
         sender_thread_udp.start()
 
     # Main loop to read ip-flows from input interface
+    batch = []  # records waiting for processing in a batch (with --batch)
+    process_batch = processor.process_records if processor else pool.process_records
     while not stop.is_set():
         # load IP flow from IFC interface
         try:
             data = trap.recv()
         except pytrap.FormatChanged as e:
+            if batch:
+                # process records of the previous format first
+                process_batch(rec, batch)
+                batch = []
             fmttype, inputspec = trap.getDataFmt(0)
             rec = pytrap.UnirecTemplate(inputspec)
             data = e.data
-            biflow_support = None
+            if processor:
+                processor.reset_format(inputspec)
+            else:
+                pool.set_format(inputspec)
         except pytrap.TimeoutError:
+            if batch:
+                process_batch(rec, batch)
+                batch = []
+            if not processor:
+                pool.flush()
             continue
         if len(data) <= 1:
             stop.set()  # signalize to the sender thread to stop
             break
-        rec.setData(data)  # set the IP flow to created template
-
-        # Autodetect if bi-flow are supported
-        if biflow_support is None:
-            try:
-                _ = rec.PACKETS_REV
-                biflow_support = True
-                dbgprint("Bi-flow support detected")
-            except AttributeError:
-                biflow_support = False
-                dbgprint("Bi-flow support not detected")
-
-        # === Process the (bi)flow ===
-        if not net_filter(rec.SRC_IP) and not net_filter(rec.DST_IP):
-            # neither SRC_IP nor DST_IP belong to the set of monitored prefixes - skip
-            continue
-
-        if rec.PROTOCOL == 6 and rec.TCP_FLAGS & 0x12 == 0x12:
-            # TCP, SYN and ACK flags set
-            # If there is no SYN flag, it's probably a continuation of a longer flow.
-            # We can't use this, as in this case it's not possible to determine which
-            # side initiated the connection from the flow timestamps. We also require
-            # ACK flag, as each successfully opened TCP connection requires both SYN
-            # and ACK flags in both directions.
-
-            # Detect if this flow is proper biflow (with both directions filled)
-            if biflow_support and rec.PACKETS > 0 and rec.PACKETS_REV > 0:
-                # it's biflow - parse needed information and detect open port
-                biflow = Biflow(
-                    rec.SRC_IP,
-                    rec.SRC_PORT,
-                    rec.DST_IP,
-                    rec.DST_PORT,
-                    rec.TIME_FIRST,
-                    rec.TIME_LAST,
-                    rec.TCP_FLAGS,
-                )
-                tcp_ports.process_biflow(biflow)
-            else:
-                # It's uniflow - try to aggregate it, if successful, detect open port
-                biflow = biflow_aggregator.process_flow(rec)
-                if biflow:
-                    tcp_ports.process_biflow(biflow)
-        elif args.udp_too and rec.PROTOCOL == 17:
-            # UDP
-            if biflow_support and rec.PACKETS > 0 and rec.PACKETS_REV > 0:
-                # it's biflow - parse needed information and detect open port
-                biflow = Biflow(
-                    *biflow_aggregator_udp.order_udp_flow_key(
-                        rec.SRC_IP, rec.SRC_PORT, rec.DST_IP, rec.DST_PORT
-                    ),
-                    rec.TIME_FIRST,
-                    rec.TIME_LAST,
-                    0,
-                )
-                udp_ports.process_biflow(biflow)
-            else:
-                # It's uniflow - try to aggregate it, if successful, detect open port
-                biflow = biflow_aggregator_udp.process_flow(rec)
-                if biflow:
-                    udp_ports.process_biflow(biflow)
+        if args.batch:
+            batch.append(data)
+            if len(batch) >= args.batch:
+                process_batch(rec, batch)
+                batch = []
+        elif processor:
+            rec.setData(data)  # set the IP flow to created template
+            processor.process_record(rec)
+        else:
+            rec.setData(data)
+            pool.process_record(rec, data)
 
-        # =========
+    if batch:
+        process_batch(rec, batch)
+    if not processor:
+        pool.flush()
 
-    # Main loop stopped, wait for the sender thread to finish
+    # Main loop stopped, wait for the sender threads to finish
     sender_thread.join()
+    if args.udp_too:
+        sender_thread_udp.join()
 
     # Send any cached data before program exit
     send_datapoints(tcp_ports, args.url, args.srctag, ATTR)
     if args.udp_too:
         send_datapoints(udp_ports, args.url, args.srctag, ATTR_UDP)
+    if not processor:
+        pool.stop()
 
     # Free allocated TRAP IFCs
     trap.finalize()
@@ -1,17 +1,53 @@
 #!/usr/bin/env python3
 
+import hashlib
 import json
+import multiprocessing
+import os
+import pickle
 import re
+import signal
 import sys
+import time
 import xml.etree.ElementTree as ET
 from argparse import ArgumentParser
-from datetime import datetime
-from typing import Callable, List, Optional, Tuple
+from collections import Counter, OrderedDict, deque
+from typing import List, Optional, Tuple
 
 import pytrap
 
+try:
+    from re import _parser as sre_parse  # Python 3.11+
+except ImportError:
+    import sre_parse
+
+try:
+    import ahocorasick  # pyahocorasick, optional (speeds up pattern prefiltering)
+except ImportError:
+    ahocorasick = None
+
+try:
+    import re2  # google-re2, optional (regex engine without backtracking)
+except ImportError:
+    re2 = None
+
 SSH_BANNER_REGEX = re.compile(r"^SSH-\d+\.\d+-")  # e.g. "SSH-2.0-"
 SUPPORTED_POS_CATEGORIES = ["openssh", "service", "host", "os"]
+# Shorter literals are not used for pattern prefiltering (they match almost always)
+MIN_PREFILTER_LITERAL_LENGTH = 3
+# Maximum number of seconds whose formatted date and time are cached
+TIME_PREFIX_CACHE_SIZE = 100000
+# Number of received records (flows) in a batch sent to a worker process
+WORKER_BATCH_SIZE = 500
+# Sleep time bounds when there are no data on any input (when polling multiple inputs)
+MIN_IDLE_SLEEP = 0.001
+MAX_IDLE_SLEEP = 0.05
+# Maximum number of distinct unknown banners counted by the profiler (when exceeded,
+# the less common half of them is forgotten) and the number of them reported
+PROFILE_UNKNOWN_BANNERS_LIMIT = 10000
+PROFILE_UNKNOWN_BANNERS_REPORTED = 100
+# Version of the format of cached prepared database (increment on incompatible changes)
+DB_CACHE_FORMAT = 1
 
 parser = ArgumentParser(
     description="Receive SSH or SMTP banners and according to given database "
@@ -30,16 +66,117 @@ parser.add_argument(
     "-d",
     metavar="DB_PATH",
     dest="db_path",
+    nargs="+",
     required=True,
-    help="Path to database (xml file) with ssh/smtp banners",
+    help="Path to database (xml file) with ssh/smtp banners (one for each mode)",
+)
+parser.add_argument(
+    "--db-cache",
+    metavar="FILE",
+    nargs="+",
+    help="File to cache the prepared database in (one for each mode). It's used "
+    "instead of the XML database when created from the same version of it, which "
+    "speeds up start and reload",
+)
+parser.add_argument(
+    "--db-check-interval",
+    metavar="SECONDS",
+    type=int,
+    default=60,
+    help="Check modification time of the database file every SECONDS and reload "
+    "it when changed (default: 60, 0 to disable; reload can also be requested "
+    "by SIGHUP)",
 )
 parser.add_argument(
     "-m",
     metavar="MODE",
     choices=["smtp", "ssh", "server", "setcookie"],
     dest="mode",
+    nargs="+",
     required=True,
-    help="Mode of detector 4 options: 'smtp', 'ssh', 'server' or 'setcookie'",
+    help="Mode of detector 4 options: 'smtp', 'ssh', 'server' or 'setcookie'. "
+    "Multiple modes can be given, each of them reads its own input interface "
+    "(in the given order)",
+)
+parser.add_argument(
+    "-c",
+    "--cache-size",
+    metavar="N",
+    type=int,
+    default=10000,
+    help="Number of recently seen banners to cache results of pattern matching for "
+    "(default: 10000, 0 to disable the cache)",
+)
+parser.add_argument(
+    "--max-banner-length",
+    metavar="N",
+    type=int,
+    default=1024,
+    help="Truncate banners to N characters before matching (default: 1024, "
+    "0 for no limit)",
+)
+parser.add_argument(
+    "--match-timeout",
+    metavar="SECONDS",
+    type=float,
+    default=0.1,
+    help="Maximum time of matching of a banner against all patterns, the banner is "
+    "considered unknown when exceeded (default: 0.1, 0 for no limit)",
+)
+parser.add_argument(
+    "--regex-engine",
+    choices=["re", "re2"],
+    default="re",
+    help="Regex engine to use: 're' (default) or 're2' (needs the google-re2 "
+    "package, doesn't backtrack; patterns not supported by it are matched by 're')",
+)
+parser.add_argument(
+    "--workers",
+    metavar="N",
+    type=int,
+    default=0,
+    help="Match banners in N worker processes (default: 0, match them in the main "
+    "process)",
+)
+parser.add_argument(
+    "--output-batch-size",
+    metavar="N",
+    type=int,
+    default=100,
+    help="Send up to N datapoints in one output message (default: 100)",
+)
+parser.add_argument(
+    "--output-batch-delay",
+    metavar="SECONDS",
+    type=float,
+    default=1.0,
+    help="Maximum time a datapoint waits for other ones to be sent with "
+    "(default: 1.0)",
+)
+parser.add_argument(
+    "-w",
+    "--dedup-window",
+    metavar="SECONDS",
+    type=int,
+    default=0,
+    help="Send identical datapoints (same IP and value) only once per this time "
+    "window, with t1/t2 covering all their occurrences (default: 0, send a "
+    "datapoint for every matching flow)",
+)
+parser.add_argument(
+    "--profile",
+    metavar="FILE",
+    help="Record statistics of pattern matching (hits, misses and time spent on "
+    "each pattern, the most common unknown banners) and write them to FILE in JSON "
+    "periodically, on SIGUSR1 and at exit",
+)
+parser.add_argument(
+    "--profile-interval",
+    metavar="SECONDS",
+    type=int,
+    default=300,
+    help="Period of writing the statistics (default: 300, 0 to write them only on "
+    "SIGUSR1 and at exit)",
 )
 parser.add_argument(
     "-v",
@@ -48,87 +185,436 @@ parser.add_argument(
     help="Print all banners and their matching information to stdout.",
 )
 args = parser.parse_args()
-path = args.db_path
-mode = args.mode
+if args.regex_engine == "re2" and re2 is None:
+    parser.error("--regex-engine re2 requires the google-re2 package")
+if len(set(args.mode)) != len(args.mode):
+    parser.error("each mode can be given only once")
+if len(args.db_path) != len(args.mode):
+    parser.error("a database (-d) must be given for each mode")
+if args.db_cache is not None and len(args.db_cache) != len(args.mode):
+    parser.error("a database cache file must be given for each mode")
 verbose = args.verbose
 trap = pytrap.TrapCtx()
 try:
-    trap.init(["-i", args.ifcspec], 1, 1)
+    trap.init(["-i", args.ifcspec], len(args.mode), 1)
 except pytrap.TrapError as e:
     print(f"PyTrap: {e}", file=sys.stderr)
     sys.exit(1)
 
-# Load the XML file
-try:
-    tree = ET.parse(path)
-except Exception as e:
-    print(f"Can't open xml file: {e}", file=sys.stderr)
-    trap.finalize()
-    sys.exit(1)
 
-root = tree.getroot()
-pattern_regex = []
-# Create a dictionary to store the fingerprints
-fingerprints = {}
-# Iterate over each fingerprint element
-for fingerprint in root.iter("fingerprint"):
-    # Extract the pattern attribute value as the dictionary key
-    pattern = fingerprint.get("pattern")
-
-    # Create a dictionary to store the fingerprint parameters
-    os = {}
-    service = {}
-    hw = {}
-    openssh = {}
-    host = {}
-    position = {}
-
-    # Iterate over each param element
-    for param in fingerprint.iter("param"):
-        # Extract the name and value attributes
-        pos = param.get("pos", "0")
-        name = param.get("name", None)
-        value = param.get("value", None)
-
-        pos = int(pos)
-        if name == "cookie" or ((value is None) and (pos == 0)) or name is None:
+def parse_db(xml_data: bytes) -> dict:
+    """Parse fingerprints from the recog XML database.
+
+    Return dict pattern -> params (dict category -> dict of information, plus
+    "position" dict of names of information taken from groups of the match).
+    """
+    root = ET.fromstring(xml_data)
+    # Create a dictionary to store the fingerprints
+    fingerprints = {}
+    # Iterate over each fingerprint element
+    for fingerprint in root.iter("fingerprint"):
+        # Extract the pattern attribute value as the dictionary key
+        pattern = fingerprint.get("pattern")
+
+        # Create a dictionary to store the fingerprint parameters
+        os = {}
+        service = {}
+        hw = {}
+        openssh = {}
+        host = {}
+        position = {}
+
+        # Iterate over each param element
+        for param in fingerprint.iter("param"):
+            # Extract the name and value attributes
+            pos = param.get("pos", "0")
+            name = param.get("name", None)
+            value = param.get("value", None)
+
+            pos = int(pos)
+            if name == "cookie" or ((value is None) and (pos == 0)) or name is None:
+                continue
+            category, item = name.split(".", 1)
+            if category == "os":
+                os[item] = value
+            elif category == "service":
+                service[item] = value
+            elif category == "hw":
+                hw[item] = value
+            elif category == "openssh":
+                openssh[item] = value
+            elif category == "host":
+                host[item] = value
+            if pos != 0 and category in SUPPORTED_POS_CATEGORIES:
+                position[name] = pos
+
+        # if record has no information continue to next one
+        if not (os or service or hw):
             continue
-        category, item = name.split(".", 1)
-        if category == "os":
-            os[item] = value
-        elif category == "service":
-            service[item] = value
-        elif category == "hw":
-            hw[item] = value
-        elif category == "openssh":
-            openssh[item] = value
-        elif category == "host":
-            host[item] = value
-        if pos != 0 and category in SUPPORTED_POS_CATEGORIES:
-            position[name] = pos
-
-    # if record has no information continue to next one
-    if not (os or service or hw):
-        continue
-
-    params = {}
-    if os:
-        params["os"] = os
-    if service:
-        params["service"] = service
-    if hw:
-        params["hw"] = hw
-    if openssh:
-        params["openssh"] = openssh
-    if host:
-        params["host"] = host
-    if position:
-        params["position"] = position
-    # Add the fingerprint to the dictionary
-    fingerprints[pattern] = params
-    pattern_regex.append(pattern)
-
-compiled_patterns = [re.compile(pattern) for pattern in pattern_regex]
+
+        params = {}
+        if os:
+            params["os"] = os
+        if service:
+            params["service"] = service
+        if hw:
+            params["hw"] = hw
+        if openssh:
+            params["openssh"] = openssh
+        if host:
+            params["host"] = host
+        if position:
+            params["position"] = position
+        # Add the fingerprint to the dictionary
+        fingerprints[pattern] = params
+    return fingerprints
+
+
+def required_literal_runs(parsed) -> List[str]:
+    """Return runs of literal characters which must be present in every string
+    matching the parsed (part of) regular expression."""
+    runs = []
+    current = []
+    for op, av in parsed:
+        if op is sre_parse.LITERAL:
+            current.append(chr(av))
+            continue
+        if current:
+            runs.append("".join(current))
+            current = []
+        if op is sre_parse.SUBPATTERN:
+            _group, add_flags, _del_flags, subpattern = av
+            if not add_flags & re.IGNORECASE:
+                runs.extend(required_literal_runs(subpattern))
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] >= 1:
+            # content of a repetition which must occur at least once
+            runs.extend(required_literal_runs(av[2]))
+        # anything else (alternatives, character sets, anchors, ...) only breaks
+        # the run of literals
+    if current:
+        runs.append("".join(current))
+    return runs
+
+
+def required_literal(pattern: str) -> Optional[str]:
+    """Return the longest literal substring which must be present in every string
+    matching the pattern, or None if there is no usable one."""
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (re.error, RecursionError):
+        return None
+    if parsed.state.flags & re.IGNORECASE:
+        return None
+    runs = required_literal_runs(parsed)
+    literal = max(runs, key=len, default="")
+    return literal if len(literal) >= MIN_PREFILTER_LITERAL_LENGTH else None
+
+
+class PatternPrefilter:
+    """Selection of patterns which can possibly match a given string.
+
+    A literal substring required by each pattern is extracted from the pattern
+    (if possible). Only patterns whose literal is present in the string, and
+    patterns without any such literal, need to be tried. All the literals are
+    searched for in a single pass using the Aho-Corasick algorithm (if the
+    pyahocorasick package is available).
+    """
+
+    def __init__(self, patterns: List[str]):
+        self._literals = []  # distinct literals
+        self._patterns_by_literal = []  # list of pattern indexes for each literal
+        self._always = []  # indexes of patterns without a literal
+        literal_ids = {}
+        for i, pattern in enumerate(patterns):
+            literal = required_literal(pattern)
+            if literal is None:
+                self._always.append(i)
+                continue
+            if literal not in literal_ids:
+                literal_ids[literal] = len(self._literals)
+                self._literals.append(literal)
+                self._patterns_by_literal.append([])
+            self._patterns_by_literal[literal_ids[literal]].append(i)
+        self._build_automaton()
+
+    def get_state(self) -> dict:
+        """Return internal state in a serializable form (see from_state)."""
+        # the automaton is not stored (it's rebuilt, pyahocorasick may be missing)
+        return {
+            "literals": self._literals,
+            "patterns_by_literal": self._patterns_by_literal,
+            "always": self._always,
+        }
+
+    @classmethod
+    def from_state(cls, state: dict) -> "PatternPrefilter":
+        prefilter = cls.__new__(cls)
+        prefilter._literals = state["literals"]
+        prefilter._patterns_by_literal = state["patterns_by_literal"]
+        prefilter._always = state["always"]
+        prefilter._build_automaton()
+        return prefilter
+
+    def _build_automaton(self):
+        self._automaton = None
+        if ahocorasick is not None and self._literals:
+            self._automaton = ahocorasick.Automaton()
+            for literal_id, literal in enumerate(self._literals):
+                self._automaton.add_word(literal, literal_id)
+            self._automaton.make_automaton()
+
+    def candidates(self, record: str) -> List[int]:
+        """Return indexes of patterns which can match the record, in the original
+        order."""
+        if self._automaton is not None:
+            found = {literal_id for _, literal_id in self._automaton.iter(record)}
+        else:
+            found = {
+                literal_id
+                for literal_id, literal in enumerate(self._literals)
+                if literal in record
+            }
+        if not found:
+            return self._always
+        indexes = list(self._always)
+        for literal_id in found:
+            indexes.extend(self._patterns_by_literal[literal_id])
+        indexes.sort()
+        return indexes
+
+
+class ResultTemplate:
+    """Precomputed construction of the result of a fingerprint.
+
+    Information taken from groups of the match (given by "position" params) and
+    the cpe23 values containing the {service.version} or {os.version}
+    placeholders are precomputed as slots filled by build(). Categories whose
+    all information is taken from groups which didn't participate in the match
+    are left out of the result.
+    """
+
+    # (placeholder, name of information replacing it) for cpe23 of each category
+    CPE23_PLACEHOLDERS = {
+        "service": ("{service.version}", "service.version"),
+        "os": ("{os.version}", "os.version"),
+    }
+
+    def __init__(self, params: dict):
+        position = params.get("position", {})
+        # tuple of (category, tuple of (item, value, group, placeholder, group))
+        categories = []
+        for category, info in params.items():
+            if category == "position":
+                continue
+            placeholder, placeholder_name = self.CPE23_PLACEHOLDERS.get(
+                category, (None, None)
+            )
+            items = []
+            for item, value in info.items():
+                group = position.get(f"{category}.{item}", 0)
+                if (
+                    item == "cpe23"
+                    and not group
+                    and placeholder_name in position
+                    and placeholder in value
+                ):
+                    items.append(
+                        (item, value, 0, placeholder, position[placeholder_name])
+                    )
+                else:
+                    items.append((item, value, group, None, 0))
+            categories.append((category, tuple(items)))
+        self._categories = tuple(categories)
+        # result of fingerprints not using the match at all is always the same
+        self._static = None if position else self._build_static()
+
+    def _build_static(self) -> dict:
+        return {
+            category: {item: value for item, value, *_ in items}
+            for category, items in self._categories
+        }
+
+    def build(self, match: "re.Match") -> dict:
+        """Return the result for the match (the result must not be modified)."""
+        if self._static is not None:
+            return self._static
+        result = {}
+        for category, items in self._categories:
+            info = {}
+            for item, value, group, placeholder, placeholder_group in items:
+                if group:
+                    value = match.group(group)
+                    if value is None:
+                        continue
+                elif placeholder_group:
+                    version = match.group(placeholder_group)
+                    if version is not None:
+                        value = value.replace(placeholder, version)
+                info[item] = value
+            if info:
+                result[category] = info
+        return result
+
+
+class RecogDB:
+    """Database of recog fingerprints prepared for matching.
+
+    Regular expressions are compiled lazily, on the first attempt to match them
+    (thanks to prefiltering, many of them are never tried). Each fingerprint is
+    prepared as a ResultTemplate.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        fingerprints: dict,
+        prefilter: Optional[PatternPrefilter] = None,
+    ):
+        self.path = path  # path of the XML file
+        self.fingerprints = fingerprints  # pattern -> params
+        self.patterns = list(fingerprints)
+        self.prefilter = prefilter or PatternPrefilter(self.patterns)
+        self._compiled = [None] * len(self.patterns)
+        self.templates = [ResultTemplate(params) for params in fingerprints.values()]
+
+    def compile_all(self):
+        """Compile all patterns now (raises re.error if any of them is invalid)."""
+        for i in range(len(self.patterns)):
+            self.compiled_pattern(i)
+
+    def compiled_pattern(self, i: int) -> "re.Pattern":
+        patt = self._compiled[i]
+        if patt is None:
+            patt = self._compiled[i] = compile_pattern(self.patterns[i])
+        return patt
+
+
+def compile_pattern(pattern: str) -> "re.Pattern":
+    """Compile the pattern by the selected regex engine."""
+    if args.regex_engine == "re2":
+        try:
+            return re2.compile(pattern)
+        except re2.error:
+            pass  # not supported by re2 (e.g. backreferences), use re
+    return re.compile(pattern)
+
+
+def load_db(path: str, cache_path: Optional[str] = None) -> RecogDB:
+    """Load the database from the XML file.
+
+    If cache_path is given, the prepared database is loaded from there instead,
+    if it was created from the same XML file (identified by its SHA-256 hash).
+    Otherwise, it's created from the XML file and stored there.
+    """
+    with open(path, "rb") as f:
+        xml_data = f.read()
+    xml_hash = hashlib.sha256(xml_data).hexdigest()
+
+    if cache_path:
+        try:
+            with open(cache_path, "rb") as f:
+                cached = pickle.load(f)
+            if (
+                cached.get("format") == DB_CACHE_FORMAT
+                and cached.get("sha256") == xml_hash
+            ):
+                prefilter = PatternPrefilter.from_state(cached["prefilter"])
+                return RecogDB(path, cached["fingerprints"], prefilter)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Can't load database cache {cache_path}: {e}", file=sys.stderr)
+
+    db = RecogDB(path, parse_db(xml_data))
+    db.compile_all()  # check all patterns are valid
+
+    if cache_path:
+        cached = {
+            "format": DB_CACHE_FORMAT,
+            "sha256": xml_hash,
+            "fingerprints": db.fingerprints,
+            "prefilter": db.prefilter.get_state(),
+        }
+        tmp_path = cache_path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"Can't store database cache {cache_path}: {e}", file=sys.stderr)
+    return db
+
+
+class DBReloader:
+    """Detection of requests to reload databases - SIGHUP signal (all of them)
+    or a change of modification time of a database file (checked periodically).
+    """
+
+    def __init__(self, inputs: List["ModeInput"], check_interval: int):
+        self.inputs = inputs
+        self.check_interval = check_interval
+        self.requested = False
+        self._mtimes = {inp.attr: self._get_mtime(inp.db_path) for inp in inputs}
+        self._changed = []  # inputs whose database file was changed
+        self._next_check = time.monotonic() + check_interval
+        signal.signal(signal.SIGHUP, self._request_reload)
+
+    def _request_reload(self, _signum, _frame):
+        self.requested = True
+
+    @staticmethod
+    def _get_mtime(path: str) -> Optional[int]:
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def reload_needed(self) -> bool:
+        if self.requested:
+            return True
+        if self.check_interval <= 0:
+            return False
+        now = time.monotonic()
+        if now < self._next_check:
+            return False
+        self._next_check = now + self.check_interval
+        for inp in self.inputs:
+            mtime = self._get_mtime(inp.db_path)
+            if mtime is not None and mtime != self._mtimes[inp.attr]:
+                self._changed.append(inp)
+        return bool(self._changed)
+
+    def reload(self) -> bool:
+        """Reload the databases (all if requested by signal, or the changed ones).
+
+        Return True if any database was replaced. On error, the current database
+        is kept.
+        """
+        to_reload = self.inputs if self.requested else self._changed
+        self.requested = False
+        self._changed = []
+        reloaded = False
+        for inp in to_reload:
+            self._mtimes[inp.attr] = self._get_mtime(inp.db_path)
+            try:
+                new_db = load_db(inp.db_path, inp.cache_path)
+            except Exception as e:
+                print(
+                    f"Can't reload database {inp.db_path}, keeping the current one: "
+                    f"{e}",
+                    file=sys.stderr,
+                )
+                continue
+            inp.db = new_db
+            reloaded = True
+            print(
+                f"Database {inp.db_path} reloaded ({len(new_db.patterns)} "
+                "fingerprints)",
+                file=sys.stderr,
+            )
+        if reloaded:
+            result_cache.clear()  # results of the old database
+        return reloaded
 
 
 def sanitize_banner(banner: str) -> str:
@@ -136,18 +622,64 @@ def sanitize_banner(banner: str) -> str:
     return "".join(c if c.isprintable() else "·" for c in banner)
 
 
-def create_datapoint(rec: pytrap.UnirecTemplate, data: dict, mode: str, ip: str) -> str:
-    tmpdic = {
-        "type": "ip",
-        "id": ip,
-        "attr": mode,
-        "v": data,
-        "t1": datetime.isoformat((rec.TIME_FIRST).toDatetime()),
-        "t2": datetime.isoformat((rec.TIME_LAST).toDatetime()),
-        "src": "",
-    }
-    datapoint = json.dumps([tmpdic])
-    return datapoint
+def create_datapoint(
+    v_json: str, attr: str, ip: str, t1: pytrap.UnirecTime, t2: pytrap.UnirecTime
+) -> str:
+    """Return JSON of the datapoint (the value is passed already JSON-encoded)."""
+    return (
+        f'{{"type": "ip", "id": "{ip}", "attr": "{attr}", "v": {v_json}, '
+        f'"t1": "{format_time(t1)}", "t2": "{format_time(t2)}", "src": ""}}'
+    )
+
+
+def format_time(t: pytrap.UnirecTime) -> str:
+    """Format time in ISO format, the same as datetime.isoformat() does
+    (YYYY-MM-DDThh:mm:ss[.ffffff])."""
+    seconds = t.getSeconds()
+    # Formatting of the date and time part is cached, most timestamps are close
+    # to the current time
+    prefix = _time_prefix_cache.get(seconds)
+    if prefix is None:
+        if len(_time_prefix_cache) >= TIME_PREFIX_CACHE_SIZE:
+            _time_prefix_cache.clear()
+        prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds))
+        _time_prefix_cache[seconds] = prefix
+    msec = t.getMiliSeconds()
+    return f"{prefix}.{msec:03d}000" if msec else prefix
+
+
+_time_prefix_cache = {}  # seconds -> formatted date and time
+
+
+class OutputBatcher:
+    """Collection of datapoints into JSON lists, each sent as one message.
+
+    The list is sent when it reaches the maximum size or when its first
+    datapoint waits for the maximum delay (see flush_due).
+    """
+
+    def __init__(self, max_size: int, max_delay: float):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._datapoints = []
+        self._deadline = 0.0
+
+    def add(self, datapoint: str):
+        if not self._datapoints:
+            self._deadline = time.monotonic() + self.max_delay
+        self._datapoints.append(datapoint)
+        if len(self._datapoints) >= self.max_size:
+            self.flush()
+
+    def flush_due(self) -> bool:
+        return bool(self._datapoints) and time.monotonic() >= self._deadline
+
+    def flush(self):
+        if not self._datapoints:
+            return
+        message = "[" + ", ".join(self._datapoints) + "]"
+        self._datapoints = []
+        trap.send(bytearray(message, "utf-8"))
 
 
 def ssh_extract_banners(
@@ -215,104 +747,633 @@ def http_setcookie_extract_banners(
     return None
 
 
-def get_data(record: str) -> Optional[dict]:
-    for patt in compiled_patterns:
-        match = patt.search(record)
-        if match:
+# Function extracting banners and required UniRec fields for each mode
+MODES = {
+    "ssh": (
+        ssh_extract_banners,
+        "ipaddr DST_IP,bytes IDP_CONTENT_REV,time TIME_FIRST,time TIME_LAST",
+    ),
+    "smtp": (
+        smtp_extract_banners,
+        "ipaddr DST_IP,bytes IDP_CONTENT_REV,time TIME_FIRST,time TIME_LAST",
+    ),
+    "server": (
+        http_server_extract_banners,
+        "ipaddr SRC_IP,string HTTP_RESPONSE_SERVER,time TIME_FIRST,time TIME_LAST",
+    ),
+    "setcookie": (
+        http_setcookie_extract_banners,
+        "ipaddr SRC_IP,string HTTP_RESPONSE_SET_COOKIE_NAMES,"
+        "time TIME_FIRST,time TIME_LAST",
+    ),
+}
+
+
+class ModeInput:
+    """Input interface of one mode of detection, with its database."""
+
+    def __init__(self, ifcidx: int, mode: str, db_path: str, cache_path: Optional[str]):
+        self.ifcidx = ifcidx
+        self.attr = "recog_" + mode
+        self.db_path = db_path
+        self.cache_path = cache_path
+        self.db = load_db(db_path, cache_path)
+        self.extract_data, inputspec = MODES[mode]
+        # Set the list of required fields in received messages.
+        trap.setRequiredFmt(ifcidx, pytrap.FMT_UNIREC, inputspec)
+        self.rec = pytrap.UnirecTemplate(inputspec)
+
+    def format_changed(self):
+        _fmttype, inputspec = trap.getDataFmt(self.ifcidx)
+        self.rec = pytrap.UnirecTemplate(inputspec)
+
+
+class DedupWindow:
+    """Aggregation of identical datapoints (same IP, attribute and value) within
+    a time window. Only the widest t1/t2 of each of them is kept in memory and
+    all of them are sent at the end of the window."""
+
+    def __init__(self, window: int):
+        self.window = window
+        # (ip, attr, JSON of value) -> [t1, t2]
+        self._entries = {}
+        self._next_flush = time.monotonic() + window
+        self.received = 0
+        self.sent = 0
+
+    def add(
+        self,
+        ip: str,
+        attr: str,
+        v_json: str,
+        t1: pytrap.UnirecTime,
+        t2: pytrap.UnirecTime,
+    ):
+        self.received += 1
+        key = (ip, attr, v_json)
+        entry = self._entries.get(key)
+        if entry is None:
+            self._entries[key] = [t1, t2]
+            return
+        entry[0] = min(t1, entry[0])
+        entry[1] = max(t2, entry[1])
+
+    def flush_due(self) -> bool:
+        return time.monotonic() >= self._next_flush
+
+    def flush(self):
+        """Send all datapoints of the current window and start a new one."""
+        entries = self._entries
+        self._entries = {}
+        self._next_flush = time.monotonic() + self.window
+        for (ip, attr, v_json), (t1, t2) in entries.items():
+            output.add(create_datapoint(v_json, attr, ip, t1, t2))
+        self.sent += len(entries)
+        if verbose:
+            print(f"-> DEDUP WINDOW FLUSHED: {len(entries)} datapoints sent")
+
+    def stats(self) -> str:
+        return f"{self.received} datapoints received, {self.sent} sent"
+
+
+class ResultCache:
+    """LRU cache of results of pattern matching (including misses, i.e. None)
+    for recently seen banners. Banners are identified by (attr, banner) tuples,
+    since each mode has its own database."""
+
+    def __init__(self, max_size: int):
+        self._max_size = max_size
+        self._results = OrderedDict()  # (attr, banner) -> result
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, banner: Tuple[str, str]) -> Tuple[bool, Optional[Tuple[dict, str]]]:
+        """Return tuple (found, result)."""
+        try:
+            result = self._results[banner]
+        except KeyError:
+            self.misses += 1
+            return False, None
+        self._results.move_to_end(banner)
+        self.hits += 1
+        return True, result
+
+    def put(self, banner: Tuple[str, str], result: Optional[Tuple[dict, str]]):
+        if self._max_size <= 0:
+            return
+        self._results[banner] = result
+        if len(self._results) > self._max_size:
+            self._results.popitem(last=False)
+
+    def clear(self):
+        """Remove all cached results (must be called when patterns are changed)."""
+        self._results.clear()
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        return (
+            f"{lookups} lookups, {self.hits} hits ({hit_rate:.1%}), "
+            f"{len(self._results)} banners cached"
+        )
+
+
+result_cache = ResultCache(args.cache_size)
+
+
+class MatchTimeout(Exception):
+    """Matching of a banner took longer than allowed."""
+
+
+class MatchLimits:
+    """Protection against banners which are expensive to match (banners are
+    controlled by remote hosts and some patterns can backtrack heavily).
+
+    Banners are truncated to a maximum length, and matching of a banner is
+    interrupted (by SIGALRM) when it exceeds the time budget.
+    """
+
+    def __init__(self, max_length: int, timeout: float):
+        self.max_length = max_length
+        self.timeout = timeout
+        self.truncated = 0
+        self.timed_out = 0
+        if timeout > 0:
+            signal.signal(signal.SIGALRM, self._raise_timeout)
+
+    @staticmethod
+    def _raise_timeout(_signum, _frame):
+        raise MatchTimeout
+
+    def truncate(self, banner: str) -> str:
+        if 0 < self.max_length < len(banner):
+            self.truncated += 1
+            return banner[: self.max_length]
+        return banner
+
+    def match(self, db: RecogDB, banner: str) -> Optional[dict]:
+        """Match the banner against patterns within the time budget (if set)."""
+        if self.timeout <= 0:
+            return match_patterns(db, banner)
+        try:
+            signal.setitimer(signal.ITIMER_REAL, self.timeout)
+            try:
+                return match_patterns(db, banner)
+            finally:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+        except MatchTimeout:
+            self.timed_out += 1
             if verbose:
-                print(f"-> MATCH: {fingerprints[patt.pattern]}")
-            data = fingerprints[patt.pattern].copy()
-
-            position = data.pop("position", False)
-            if position:
-                # iterate through position dictionary
-                # and add to data dict information from regex match
-                for name, pos in position.items():
-                    if name == "cookie":
-                        continue
-                    else:
-                        category, item = name.split(".", 1)
-                    value = match.group(pos)
-                    if value is None:
-                        data[category].pop(item)
-                        if not data[category]:
-                            data.pop(category)
-                        continue
-                    # store the obtained information to data dictionary
-                    data[category][item] = value
-
-                    # replace part of cpe23 value with the obtained information
-                    if name == "service.version":
-                        if "cpe23" in data["service"]:
-                            data["service"]["cpe23"] = data["service"]["cpe23"].replace(
-                                "{service.version}", value
-                            )
-                    elif name == "os.version" and "cpe23" in data["os"]:
-                        data["os"]["cpe23"] = data["os"]["cpe23"].replace(
-                            "{os.version}", value
-                        )
-
-            return data
+                print("-> MATCHING TIMED OUT")
+            return None
+
+    def stats(self) -> str:
+        return f"{self.truncated} banners truncated, {self.timed_out} timed out"
+
+
+match_limits = MatchLimits(args.max_banner_length, args.match_timeout)
+
+
+def get_data(inp: ModeInput, record: str) -> Optional[Tuple[dict, str]]:
+    """Return information obtained from the record (banner) by the first matching
+    pattern of the database of the input, together with its JSON representation
+    (canonical, so usable as a key), or None if no pattern matches. Results are
+    cached (banners whose matching timed out are cached as unknown)."""
+    key = (inp.attr, record)
+    found, result = result_cache.get(key)
+    if found:
+        if verbose:
+            print(f"-> CACHED: {result[0]}" if result else "-> UNKNOWN BANNER (cached)")
+        return result
+    result = match_banner(inp.db, record)
+    result_cache.put(key, result)
+    return result
+
+
+def match_banner(db: RecogDB, record: str) -> Optional[Tuple[dict, str]]:
+    """Like get_data, without using the result cache."""
+    data = match_limits.match(db, record)
+    return (data, json.dumps(data, sort_keys=True)) if data else None
+
+
+def match_banners(
+    banners: List[Tuple[str, str]],
+) -> Tuple[list, int, Optional[dict]]:
+    """Match a batch of (attr, banner) tuples (in a worker process).
+
+    Return results for the banners, the number of banners which timed out and
+    statistics of the profiler for this batch (if profiling is enabled).
+    """
+    if profiler is not None:
+        profiler.take_matching_stats()  # forget what was inherited or sent
+    timed_out = match_limits.timed_out
+    results = [match_banner(inputs[attr].db, banner) for attr, banner in banners]
+    stats = profiler.take_matching_stats() if profiler is not None else None
+    return results, match_limits.timed_out - timed_out, stats
+
+
+def ignore_stop_signals():
+    """Initializer of worker processes - signals are handled by the main process,
+    which stops the workers (after all the pending batches are processed)."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+class MatchingPool:
+    """Matching of banners in worker processes.
+
+    Received records are collected into batches, banners with cached results
+    are resolved immediately and the others are sent to a worker process
+    (each banner once per batch). Batches are processed in parallel, but
+    their results are collected in the order in which they were received, so
+    output is the same as without workers. Workers are forked, so they get the
+    currently loaded databases.
+    """
+
+    def __init__(self, workers: int):
+        self._pool = multiprocessing.get_context("fork").Pool(
+            workers, initializer=ignore_stop_signals
+        )
+        self._max_pending = 2 * workers
+        self._jobs = deque()  # (records, results, misses, AsyncResult or None)
+        self._new_batch()
+
+    def _new_batch(self):
+        self._records = []  # (attr, ip, banners, t1, t2)
+        self._results = {}  # (attr, banner) -> result
+        # (attr, banner) not found in cache (dict used as ordered set)
+        self._misses = {}
+
+    def add(
+        self,
+        attr: str,
+        ip: str,
+        banners: List[str],
+        t1: pytrap.UnirecTime,
+        t2: pytrap.UnirecTime,
+    ):
+        for banner in banners:
+            key = (attr, banner)
+            if key in self._results or key in self._misses:
+                continue
+            found, result = result_cache.get(key)
+            if found:
+                self._results[key] = result
+            else:
+                self._misses[key] = None
+        self._records.append((attr, ip, banners, t1, t2))
+        if len(self._records) >= WORKER_BATCH_SIZE:
+            self.dispatch()
+
+    def dispatch(self):
+        """Send the current batch to a worker and process all finished batches."""
+        if self._records:
+            misses = list(self._misses)
+            job = self._pool.apply_async(match_banners, (misses,)) if misses else None
+            self._jobs.append((self._records, self._results, misses, job))
+            self._new_batch()
+        self.collect(wait=len(self._jobs) > self._max_pending)
+
+    def collect(self, wait: bool = False, wait_all: bool = False):
+        """Process finished batches (in order). If wait is set, wait for the
+        oldest one to finish, if wait_all is set, wait for all of them."""
+        while self._jobs:
+            records, results, misses, job = self._jobs[0]
+            if job is not None:
+                if not (wait or wait_all or job.ready()):
+                    break
+                miss_results, timed_out, profile_stats = job.get()
+                match_limits.timed_out += timed_out
+                if profile_stats is not None:
+                    profiler.add_matching_stats(profile_stats)
+                for key, result in zip(misses, miss_results):
+                    result_cache.put(key, result)
+                    results[key] = result
+            self._jobs.popleft()
+            wait = False
+            for attr, ip, banners, t1, t2 in records:
+                for banner in banners:
+                    handle_result(attr, ip, banner, results[(attr, banner)], t1, t2)
+
+    def close(self):
+        """Process all remaining records and stop worker processes."""
+        self.dispatch()
+        self.collect(wait_all=True)
+        self._pool.close()
+        self._pool.join()
+
+
+def match_patterns(db: RecogDB, record: str) -> Optional[dict]:
+    if profiler is not None:
+        i, match = profiler.search_patterns(db, record)
+    else:
+        i, match = search_patterns(db, record)
+    if match:
+        if verbose:
+            print(f"-> MATCH: {db.fingerprints[db.patterns[i]]}")
+        return db.templates[i].build(match)
 
     if verbose:
         print("-> UNKNOWN BANNER")
     return None
 
 
-def do_detection(
-    rec: pytrap.UnirecTemplate,
-    extract_data: Callable[[pytrap.UnirecTemplate], Optional[Tuple[List[str], str]]],
-    mode: str,
-) -> None:
-    result_or_none = extract_data(rec)
+def search_patterns(db: RecogDB, record: str) -> Tuple[int, Optional["re.Match"]]:
+    """Return index of the first pattern matching the record and the match,
+    or (-1, None)."""
+    for i in db.prefilter.candidates(record):
+        match = db.compiled_pattern(i).search(record)
+        if match:
+            return i, match
+    return -1, None
+
+
+class Profiler:
+    """Statistics of pattern matching, for tuning of the databases.
+
+    For each pattern (of each database), the number of banners it matched
+    (hits) and didn't match (misses) when tried, the number of timeouts and
+    the cumulative time spent matching it are recorded; the numbers of banners
+    matched and patterns tried show how effective the prefilter is. Occurrences
+    of unknown banners are counted as well (only the most common ones are kept).
+    The statistics are written to a file in JSON periodically and on SIGUSR1.
+    """
+
+    def __init__(self, path: str, interval: int):
+        self.path = path
+        self.interval = interval
+        self.requested = False
+        self._next_dump = time.monotonic() + interval
+        self.unknown_banners = Counter()  # (attr, banner) -> count
+        # (db path, pattern) -> [hits, misses, timeouts, seconds]
+        self.patterns = {}
+        self.banners_matched = 0
+        self.patterns_tried = 0
+        signal.signal(signal.SIGUSR1, self._request_dump)
+
+    def _request_dump(self, _signum, _frame):
+        self.requested = True
+
+    def take_matching_stats(self) -> dict:
+        """Return statistics of matching and reset them."""
+        stats = {
+            "patterns": self.patterns,
+            "banners_matched": self.banners_matched,
+            "patterns_tried": self.patterns_tried,
+        }
+        self.patterns = {}
+        self.banners_matched = 0
+        self.patterns_tried = 0
+        return stats
+
+    def add_matching_stats(self, stats: dict):
+        """Add statistics of matching (from a worker process)."""
+        self.banners_matched += stats["banners_matched"]
+        self.patterns_tried += stats["patterns_tried"]
+        for key, values in stats["patterns"].items():
+            entry = self.patterns.setdefault(key, [0, 0, 0, 0.0])
+            for i, value in enumerate(values):
+                entry[i] += value
+
+    def search_patterns(
+        self, db: RecogDB, record: str
+    ) -> Tuple[int, Optional["re.Match"]]:
+        """Same as search_patterns(), recording the statistics."""
+        self.banners_matched += 1
+        for i in db.prefilter.candidates(record):
+            self.patterns_tried += 1
+            key = (db.path, db.patterns[i])
+            entry = self.patterns.get(key)
+            if entry is None:
+                entry = self.patterns[key] = [0, 0, 0, 0.0]
+            patt = db.compiled_pattern(i)
+            start = time.perf_counter()
+            try:
+                match = patt.search(record)
+            except MatchTimeout:
+                entry[2] += 1
+                raise
+            finally:
+                entry[3] += time.perf_counter() - start
+            if match:
+                entry[0] += 1
+                return i, match
+            entry[1] += 1
+        return -1, None
+
+    def unknown_banner(self, attr: str, banner: str):
+        self.unknown_banners[(attr, banner)] += 1
+        if len(self.unknown_banners) > PROFILE_UNKNOWN_BANNERS_LIMIT:
+            self.unknown_banners = Counter(
+                dict(
+                    self.unknown_banners.most_common(PROFILE_UNKNOWN_BANNERS_LIMIT // 2)
+                )
+            )
+
+    def dump_due(self) -> bool:
+        if self.requested:
+            return True
+        return self.interval > 0 and time.monotonic() >= self._next_dump
+
+    def dump(self):
+        """Write the statistics (collected since start) to the file."""
+        self.requested = False
+        self._next_dump = time.monotonic() + self.interval
+        patterns = [
+            {
+                "database": db_path,
+                "pattern": pattern,
+                "hits": hits,
+                "misses": misses,
+                "timeouts": timeouts,
+                "time": round(seconds, 6),
+            }
+            for (db_path, pattern), (hits, misses, timeouts, seconds) in sorted(
+                self.patterns.items(), key=lambda item: item[1][3], reverse=True
+            )
+        ]
+        unknown_banners = [
+            {"attr": attr, "banner": banner, "count": count}
+            for (attr, banner), count in self.unknown_banners.most_common(
+                PROFILE_UNKNOWN_BANNERS_REPORTED
+            )
+        ]
+        report = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()),
+            "banners_matched": self.banners_matched,
+            "patterns_tried": self.patterns_tried,
+            "result_cache": {"hits": result_cache.hits, "misses": result_cache.misses},
+            "truncated_banners": match_limits.truncated,
+            "timed_out_banners": match_limits.timed_out,
+            "patterns": patterns,
+            "unknown_banners": unknown_banners,
+        }
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(report, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Can't write profile to {self.path}: {e}", file=sys.stderr)
+
+
+profiler = Profiler(args.profile, args.profile_interval) if args.profile else None
+
+
+def do_detection(inp: ModeInput) -> None:
+    rec = inp.rec
+    result_or_none = inp.extract_data(rec)
     if result_or_none is None:
         return
     records, ip = result_or_none
-    for record in records:
-        data = get_data(record)
-        if data:
-            datapoint = create_datapoint(rec, data, mode, ip)
-            trap.send(bytearray(datapoint, "utf-8"))
-
-
-# Set the list of required fields in received messages.
-if mode == "ssh":
-    extract_data = ssh_extract_banners
-    inputspec = "ipaddr DST_IP,bytes IDP_CONTENT_REV,time TIME_FIRST,time TIME_LAST"
-elif mode == "smtp":
-    extract_data = smtp_extract_banners
-    inputspec = "ipaddr DST_IP,bytes IDP_CONTENT_REV,time TIME_FIRST,time TIME_LAST"
-elif mode == "server":
-    extract_data = http_server_extract_banners
-    inputspec = (
-        "ipaddr SRC_IP,string HTTP_RESPONSE_SERVER,time TIME_FIRST,time TIME_LAST"
-    )
+    banners = [match_limits.truncate(record) for record in records]
+    if matching_pool is not None:
+        matching_pool.add(inp.attr, ip, banners, rec.TIME_FIRST, rec.TIME_LAST)
+        return
+    for banner in banners:
+        handle_result(
+            inp.attr, ip, banner, get_data(inp, banner), rec.TIME_FIRST, rec.TIME_LAST
+        )
+
+
+def handle_result(
+    attr: str,
+    ip: str,
+    banner: str,
+    result: Optional[Tuple[dict, str]],
+    t1: pytrap.UnirecTime,
+    t2: pytrap.UnirecTime,
+) -> None:
+    """Send the datapoint with the result (if any), or pass it to dedup window."""
+    if not result:
+        if profiler is not None:
+            profiler.unknown_banner(attr, banner)
+        return
+    v_json = result[1]
+    if dedup is not None:
+        dedup.add(ip, attr, v_json, t1, t2)
+    else:
+        output.add(create_datapoint(v_json, attr, ip, t1, t2))
+
+
+output = OutputBatcher(args.output_batch_size, args.output_batch_delay)
+dedup = DedupWindow(args.dedup_window) if args.dedup_window > 0 else None
+
+inputs = {}  # attr -> ModeInput
+for ifcidx, (mode, db_path) in enumerate(zip(args.mode, args.db_path)):
+    cache_path = args.db_cache[ifcidx] if args.db_cache else None
+    try:
+        inp = ModeInput(ifcidx, mode, db_path, cache_path)
+    except Exception as e:
+        print(f"Can't load database {db_path}: {e}", file=sys.stderr)
+        trap.finalize()
+        sys.exit(1)
+    inputs[inp.attr] = inp
+trap.setDataFmt(0, pytrap.FMT_JSON, "adict_datapoint")
+
+reloader = DBReloader(list(inputs.values()), args.db_check_interval)
+matching_pool = MatchingPool(args.workers) if args.workers > 0 else None
+
+if len(inputs) > 1:
+    # inputs are polled in turn, don't wait for data on any of them (TRAP_NO_WAIT)
+    recv_timeout = 0
+elif dedup is not None or matching_pool is not None or output.max_size > 1:
+    # don't wait for data longer than 0.5 s, so the dedup window and output are
+    # flushed and results from workers are processed in time
+    recv_timeout = 500000
 else:
-    extract_data = http_setcookie_extract_banners
-    inputspec = (
-        "ipaddr SRC_IP,string HTTP_RESPONSE_SET_COOKIE_NAMES,"
-        "time TIME_FIRST,time TIME_LAST"
+    # check the stop flag at least every 0.5 s even if no data are received
+    recv_timeout = 500000
+for inp in inputs.values():
+    trap.ifcctl(
+        ifcidx=inp.ifcidx,
+        dir_in=True,
+        request=pytrap.CTL_TIMEOUT,
+        value=recv_timeout,
     )
 
-trap.setRequiredFmt(0, pytrap.FMT_UNIREC, inputspec)
-rec = pytrap.UnirecTemplate(inputspec)
-trap.setDataFmt(0, pytrap.FMT_JSON, "adict_datapoint")
 
-mode = "recog_" + mode
+def reload_dbs():
+    """Reload databases (and restart workers, so they use the new ones)."""
+    global matching_pool  # noqa PLW0603
+    if matching_pool is None:
+        reloader.reload()
+        return
+    # Records received so far are matched by the workers with the old databases
+    # first, so their results don't get into the cache after it's cleared
+    matching_pool.close()
+    reloader.reload()
+    matching_pool = MatchingPool(args.workers)
+
+
+def stop_program(signum, frame):
+    global stop  # noqa PLW0603
+    stop = True
+    # Reset signal handlers to default, so second signal closes
+    # the program immediately
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if verbose:
+        print(
+            "Signal received. "
+            "Going to stop the program after the cached data are sent. "
+            "Press Ctrl-C again to exit immediately."
+        )
+
 
+# Stop on common stopping signals after all the pending data are processed and sent
+stop = False
+signal.signal(signal.SIGINT, stop_program)
+signal.signal(signal.SIGTERM, stop_program)
 
 # Main loop
-while True:
-    try:
-        data = trap.recv()
-    except pytrap.FormatChanged as e:
-        fmttype, inputspec = trap.getDataFmt(0)
-        rec = pytrap.UnirecTemplate(inputspec)
-        data = e.data
-    if len(data) <= 1:
-        break
-    rec.setData(data)
-    do_detection(rec, extract_data, mode)
+active_inputs = list(inputs.values())
+idle_sleep = 0.0
+while active_inputs and not stop:
+    received = False
+    for inp in list(active_inputs):
+        try:
+            data = trap.recv(inp.ifcidx)
+        except pytrap.FormatChanged as e:
+            inp.format_changed()
+            data = e.data
+        except pytrap.TimeoutError:
+            continue
+        if len(data) <= 1:
+            active_inputs.remove(inp)  # end of data on this input
+            continue
+        received = True
+        inp.rec.setData(data)
+        do_detection(inp)
+
+    if not received and matching_pool is not None:
+        matching_pool.dispatch()
+    if dedup is not None and dedup.flush_due():
+        dedup.flush()
+    if output.flush_due():
+        output.flush()
+    if reloader.reload_needed():
+        reload_dbs()
+    if profiler is not None and profiler.dump_due():
+        profiler.dump()
+    if received:
+        idle_sleep = 0.0
+    elif recv_timeout == 0 and active_inputs:
+        # no data on any input, wait a while (longer and longer, up to a limit)
+        idle_sleep = min(max(2 * idle_sleep, MIN_IDLE_SLEEP), MAX_IDLE_SLEEP)
+        time.sleep(idle_sleep)
+
+if matching_pool is not None:
+    matching_pool.close()
+if dedup is not None:
+    dedup.flush()
+    print(f"Dedup window: {dedup.stats()}", file=sys.stderr)
+output.flush()
+if args.cache_size > 0:
+    print(f"Result cache: {result_cache.stats()}", file=sys.stderr)
+print(f"Matching: {match_limits.stats()}", file=sys.stderr)
+if profiler is not None:
+    profiler.dump()
 
 # Free allocated TRAP IFCs
 trap.finalize()